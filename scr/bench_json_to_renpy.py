@@ -0,0 +1,240 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import json_to_renpy
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+# 比基线慢超过这个比例即视为回归
+REGRESSION_THRESHOLD = 1.2
+
+
+# -------------------------- 合成剧情图 --------------------------
+def make_node(node_id: int, parent_id: int = None, children: list[int] = None, **fields) -> dict:
+    node = {
+        "id": str(node_id),
+        "name": ("旁白", "Alice", "Bob", "小明")[node_id % 4],
+        "content": f"第{node_id}句台词",
+        "parent_id": "" if parent_id is None else str(parent_id),
+        "children": [str(c) for c in (children or [])],
+    }
+    # 少量节点带资源与 flag，覆盖资源登记和表达式解析
+    if node_id % 97 == 0:
+        node["background"] = f"bg/scene_{node_id % 5}.png"
+        node["transition"] = "fade"
+    if node_id % 89 == 0:
+        node["character"] = "[alice/smile.png, bob/normal.png]"
+        node["music"] = "audio/theme.ogg"
+    if node_id % 83 == 0:
+        node["setOrChangeFlag"] = "affection=1, route=2"
+    node.update(fields)
+    return node
+
+
+def linear_chain(size: int) -> list[dict]:
+    return [make_node(i, i - 1 if i else None, [i + 1] if i < size - 1 else []) for i in range(size)]
+
+
+def menu_fanout(size: int, width: int = 8) -> list[dict]:
+    # 每个枢纽节点一个 width 选项的菜单：前 width-1 个选项通向结局叶子，最后一个通向下一个枢纽
+    nodes = []
+    hub = 0
+    while hub + width + 1 <= size:
+        leaves = list(range(hub + 1, hub + width))
+        next_hub = hub + width if hub + width * 2 + 1 <= size else None
+        children = leaves + ([next_hub] if next_hub is not None else [])
+        menu = [{"content": f"选项{k}", "flag": f"choice_{k}=1" if k % 2 else ""} for k in range(len(children))]
+        nodes.append(make_node(hub, hub - width if hub else None, children, menu=menu))
+        nodes.extend(make_node(leaf, hub, []) for leaf in leaves)
+        if next_hub is None:
+            break
+        hub = next_hub
+    return nodes
+
+
+def check_flag_ladder(size: int) -> list[dict]:
+    # 每一级用 checkFlag 判断：满足条件进入下一级，否则落到旁支叶子
+    nodes = []
+    rung = 0
+    while rung + 2 < size:
+        next_rung = rung + 2 if rung + 4 < size else None
+        side = rung + 1
+        check_flag = {str(side): f"level<{rung // 2}"}
+        children = [side]
+        if next_rung is not None:
+            check_flag = {str(next_rung): f"level>={rung // 2}", **check_flag}
+            children = [next_rung, side]
+        nodes.append(make_node(rung, rung - 2 if rung else None, children, checkFlag=check_flag))
+        nodes.append(make_node(side, rung, []))
+        if next_rung is None:
+            break
+        rung = next_rung
+    return nodes
+
+
+def diamond_merges(size: int) -> list[dict]:
+    # A(菜单) -> B / C -> D(合并点) -> 下一个 A，每个 D 的入度为 2，覆盖 is_merge_point
+    nodes = []
+    base = 0
+    while base + 4 <= size:
+        a, b, c, d = base, base + 1, base + 2, base + 3
+        next_a = base + 4 if base + 8 <= size else None
+        menu = [{"content": "左", "flag": "side=1"}, {"content": "右", "flag": "side=2"}]
+        nodes.append(make_node(a, base - 1 if base else None, [b, c], menu=menu))
+        nodes.append(make_node(b, a, [d]))
+        nodes.append(make_node(c, a, [d]))
+        nodes.append(make_node(d, b, [next_a] if next_a is not None else []))
+        if next_a is None:
+            break
+        base = next_a
+    return nodes
+
+
+SHAPES = {
+    'linear': linear_chain,
+    'menu_fanout': menu_fanout,
+    'check_flag_ladder': check_flag_ladder,
+    'diamond': diamond_merges,
+}
+
+
+def make_dialogue(shape: str, size: int) -> dict:
+    return {"dialogue_name": f"bench_{shape}_{size}", "dialogue_content": SHAPES[shape](size)}
+
+
+# -------------------------- 测量 --------------------------
+def time_call(func, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(func) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_case(shape: str, size: int, repeat: int, measure_memory: bool, work_dir: str) -> dict:
+    dialogue = make_dialogue(shape, size)
+    json_path = os.path.join(work_dir, f'{shape}_{size}.json')
+    output_path = os.path.join(work_dir, f'{shape}_{size}.rpy')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(dialogue, f, ensure_ascii=False)
+
+    script = json_to_renpy.RenPyGenerator(dialogue).generate()
+    line_count = script.count('\n') + 1
+    del script
+
+    def run_generate():
+        json_to_renpy.RenPyGenerator(dialogue).generate()
+
+    def run_convert():
+        json_to_renpy.convert_json_to_renpy(json_path, output_path)
+
+    result = {'nodes': len(dialogue['dialogue_content']), 'lines': line_count}
+    for name, func in (('generate', run_generate), ('convert', run_convert)):
+        seconds = time_call(func, repeat)
+        result[name] = {
+            'seconds': seconds,
+            'lines_per_sec': line_count / seconds if seconds else None,
+            'peak_bytes': peak_memory(func) if measure_memory else None,
+        }
+    return result
+
+
+def run_benchmarks(shapes: list[str], sizes: list[int], repeat: int = 3, measure_memory: bool = True) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for shape in shapes:
+            for size in sizes:
+                key = f'{shape}/{size}'
+                results[key] = bench_case(shape, size, repeat, measure_memory, work_dir)
+                print_result(key, results[key])
+    return results
+
+
+# -------------------------- 报告与基线 --------------------------
+def print_result(key: str, result: dict) -> None:
+    parts = [f"{key:<28} nodes={result['nodes']:<8} lines={result['lines']:<8}"]
+    for name in ('generate', 'convert'):
+        stats = result[name]
+        text = f"{name}: {stats['seconds'] * 1000:9.1f}ms {stats['lines_per_sec'] or 0:>11,.0f} lines/s"
+        if stats['peak_bytes'] is not None:
+            text += f" peak {stats['peak_bytes'] / (1 << 20):7.1f}MiB"
+        parts.append(text)
+    print('  '.join(parts))
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        for name in ('generate', 'convert'):
+            ratio = result[name]['seconds'] / base[name]['seconds']
+            marker = 'REGRESSION' if ratio > threshold else 'ok'
+            print(f"{key:<28} {name:<8} {ratio:5.2f}x baseline  {marker}")
+            if ratio > threshold:
+                regressions.append(f'{key} {name}')
+    return regressions
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: dict) -> None:
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    print(f"Baseline saved to: {path}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark json_to_renpy on synthetic story graphs.")
+    arg_parser.add_argument('--shapes', default=','.join(SHAPES),
+                            help=f"comma-separated subset of: {', '.join(SHAPES)}")
+    arg_parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                            help='comma-separated node counts, e.g. 1000,10000,100000,1000000')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='timing runs per case (best is kept)')
+    arg_parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc peak-memory pass')
+    arg_parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON file')
+    arg_parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    args = arg_parser.parse_args()
+
+    shapes = [s for s in args.shapes.split(',') if s]
+    unknown = [s for s in shapes if s not in SHAPES]
+    if unknown:
+        print(f"Error: Unknown shape(s): {', '.join(unknown)}")
+        sys.exit(1)
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+
+    results = run_benchmarks(shapes, sizes, args.repeat, not args.no_memory)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+    else:
+        baseline = load_baseline(args.baseline)
+        if baseline and compare_with_baseline(results, baseline):
+            sys.exit(1)
@@ -0,0 +1,92 @@
+from collections import deque
+
+# 超出预算时一次淘汰到预算的这个比例，避免每轮都淘汰/总结
+EVICT_TARGET_RATIO = 0.75
+# 每条消息的格式开销(角色、分隔符等)的近似 token 数
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = '以下是之前对话的摘要：\n'
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 字 1 token，其余约 4 字符 1 token"""
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+class ChatHistory:
+    """有 token 预算的对话历史。
+
+    pinned 中的消息(系统提示词等)始终保留在最前面；append 只追加消息，超出预算后由调用方调用 evict
+    从最旧的开始淘汰，需要总结时再把被淘汰的内容合并成摘要交给 set_summary。
+    淘汰与总结分开，同步和异步的调用方可以各自用合适的方式请求模型生成摘要。
+    每条消息的 token 数只计算一次。
+    """
+
+    def __init__(self, max_tokens=None, token_counter=estimate_tokens):
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter
+        self.pinned = []
+        self.summary = None
+        self._turns = deque()
+        self._pinned_tokens = 0
+        self._summary_tokens = 0
+        self._turn_tokens = 0
+
+    def _count(self, message) -> int:
+        return self.token_counter(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+    @property
+    def total_tokens(self) -> int:
+        return self._pinned_tokens + self._summary_tokens + self._turn_tokens
+
+    def pin(self, message) -> None:
+        self.pinned.append(message)
+        self._pinned_tokens += self._count(message)
+
+    def append(self, role, content) -> None:
+        message = {"role": role, "content": content}
+        tokens = self._count(message)
+        self._turns.append((message, tokens))
+        self._turn_tokens += tokens
+
+    def evict(self) -> list:
+        """超出预算时淘汰最旧的消息，返回被淘汰的消息列表(未超出时为空)"""
+        evicted = []
+        if self.max_tokens is None or self.total_tokens <= self.max_tokens:
+            return evicted
+        target = self.max_tokens * EVICT_TARGET_RATIO
+        # 至少保留最新的一条消息
+        while len(self._turns) > 1 and self.total_tokens > target:
+            message, tokens = self._turns.popleft()
+            self._turn_tokens -= tokens
+            evicted.append(message)
+        # 不留下缺了提问的回答
+        while len(self._turns) > 1 and self._turns[0][0]['role'] == 'assistant':
+            message, tokens = self._turns.popleft()
+            self._turn_tokens -= tokens
+            evicted.append(message)
+        return evicted
+
+    def set_summary(self, summary) -> None:
+        self.summary = summary or None
+        self._summary_tokens = self._count(self._summary_message()) if self.summary else 0
+
+    def _summary_message(self):
+        return {"role": "system", "content": SUMMARY_PREFIX + self.summary}
+
+    def to_messages(self) -> list:
+        messages = list(self.pinned)
+        if self.summary:
+            messages.append(self._summary_message())
+        messages.extend(message for message, _ in self._turns)
+        return messages
+
+    def clear(self) -> None:
+        """清空对话与摘要，保留 pinned 消息"""
+        self._turns.clear()
+        self._turn_tokens = 0
+        self.summary = None
+        self._summary_tokens = 0
+
+    def __len__(self):
+        return len(self.pinned) + (1 if self.summary else 0) + len(self._turns)
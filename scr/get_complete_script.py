@@ -1,57 +1,72 @@
 import llm_chat
 import const
-from pydantic import BaseModel, Field
-from typing import List
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 import tools
-
-
-class ArticleCompleteScript(BaseModel):
-    article_script_name: str = Field(description="剧本的名字")
-    paragraph_num: int = Field(description="剧本的分段的数目")
-    content: List[str] = Field(description="剧本的完整内容，按段落分")
-    site: str = Field(description="该分段的地点名")
+import refine
+from schemas import ArticleCompleteScript, ArticleOutline
 
 
 parser = PydanticOutputParser(pydantic_object=ArticleCompleteScript)
 prompt = PromptTemplate(
     template="""你是一个作家。请根据所给的内容输出作品的完整剧本,并进行合理分段，并保证剧情连贯。要求内容完整充实，分段合理。：
     分段要求：如地点变化必须新分一段。同一段中场景地点必须只有一个
-    创作要求：{text}
-
     请严格按照以下格式输出,不要添加任何额外说明：：
     {format_instructions}
 
+    创作要求：{text}
+
     输出：""",
     input_variables=["text"],
     partial_variables={"format_instructions": parser.get_format_instructions()}
 )
 
-llm = llm_chat.LlmChat(
-    model_name='deepseek-reasoner',
-    temperature=1.5,
-    model_provider='openai',
-    base_url='https://api.deepseek.com',
-    api_key=const.api_key,
-    pydantic_object=ArticleCompleteScript,
-    prompt_template=prompt
-)
-strict_model = False
-path = '2026-02-02 22_28_06.json'
-get_outline = str(tools.read_json_file(f'../data/outline/{path}'))
-llm.new_message = ''
-while True:
+FINALIZE_PROMPT = '以上为最终确定的剧本，按我要求的格式输出剧本内容，不要剧本内容进行额外删改，也不要有多余内容'
+
+
+def create_llm():
+    return llm_chat.LlmChat(
+        model_name='deepseek-reasoner',
+        temperature=1.5,
+        model_provider='openai',
+        base_url='https://api.deepseek.com',
+        api_key=const.api_key,
+        pydantic_object=ArticleCompleteScript,
+        prompt_template=prompt
+    )
+
+
+def draft_complete_script(outline: ArticleOutline, llm, strict_model: bool = False, **refine_options) -> str:
+    """根据大纲写出完整剧本并通过评价，返回剧本文本；refine_options 见 refine.refine"""
+    llm.change_temperature(1.5)
+    get_outline = str(outline.model_dump())
     user_input = f'根据大纲完成完整剧本的创作，要求根据所给的内容输出作品的完整剧本,并进行合理分段，并保证剧情连贯。要求内容完整充实，分段合理。对不同的分段之间应保证剧情的连贯性。分段要求：如地点变化必须新分一段。同一段中场景地点必须只有一个。以下为原大纲内容{get_outline}'
-    llm.singe_chat(user_input)
-    eva = llm.evaluate_result(llm.new_message, '剧本')
-    if eva.res == "Perfect" or (eva.res == "Good" and not strict_model):
-        print(llm.new_message)
-        x = llm.new_message
-        llm.change_temperature(0.0)
-        result = llm.structured_chat(str(x)+'\n'+'以上为最终确定的剧本，按我要求的格式输出剧本内容，不要剧本内容进行额外删改，也不要有多余内容')
-        tools.save_dict_to_json(result.model_dump(), f'../data/complete_script/{path}')
-        break
-    else:
-        llm.singe_chat(
-            f'完成剧本的修改。原剧本:{llm.new_message}.\n用户原始要求（务必参考）{user_input}\n其他修改建议:{eva.reason_and_advise}')
+    return refine.refine(
+        llm, user_input,
+        lambda draft, advise: f'{user_input}\n以上为用户原始要求（务必参考）。完成剧本的修改。原剧本:{draft}.\n其他修改建议:{advise}',
+        '剧本', strict_model, prefix=user_input, name='get_complete_script', **refine_options)
+
+
+def generate_complete_script(outline: ArticleOutline, llm=None, strict_model: bool = False,
+                             **refine_options) -> ArticleCompleteScript:
+    """根据大纲写出完整剧本，评价通过后转为分段的结构化结果"""
+    llm = llm or create_llm()
+    x = draft_complete_script(outline, llm, strict_model, **refine_options)
+    llm.change_temperature(0.0)
+    return llm.structured_chat(str(x)+'\n'+FINALIZE_PROMPT)
+
+
+def stream_complete_script(outline: ArticleOutline, llm=None, strict_model: bool = False, **refine_options):
+    """同 generate_complete_script，但结构化输出边接收边解析：每完成一段就 yield 该段内容，生成器的返回值为完整剧本"""
+    llm = llm or create_llm()
+    x = draft_complete_script(outline, llm, strict_model, **refine_options)
+    llm.change_temperature(0.0)
+    return (yield from llm.stream_structured_chat(str(x)+'\n'+FINALIZE_PROMPT, field='content'))
+
+
+if __name__ == "__main__":
+    strict_model = False
+    path = '2026-02-02 22_28_06.json'
+    outline = tools.read_json_file(f'../data/outline/{path}', schema=ArticleOutline)
+    result = generate_complete_script(outline, strict_model=strict_model)
+    tools.save_dict_to_json(result.model_dump(), f'../data/complete_script/{path}')
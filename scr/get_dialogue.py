@@ -1,23 +1,17 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import llm_chat
 import const
-from pydantic import BaseModel, Field
-from typing import List
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 import tools
+import refine
+from schemas import ArticleCompleteScript, Dialogue
 
-# 首先定义对话项的子模型
-class DialogueItem(BaseModel):
-    name: str = Field(description="说话者的名字。若是旁白则写‘旁白’")
-    dialogue_content: str = Field(description="该说话者说的内容，合理分句，单句应不超过15字")
-
-
-# 然后定义主模型，包含对话项列表
-class Dialogue(BaseModel):
-    dialogues: List[DialogueItem] = Field(description="具体的对话列表")
-    chapter_name: str = Field(description="这个章节的名称")
-    site: str = Field(description="这个章节故事的地点的详细描述")
-
+# 同时生成的段落数；各段的生成-评价-修改循环互不依赖，总耗时接近最慢的一段
+DEFAULT_WORKERS = 4
 
 parser = PydanticOutputParser(pydantic_object=Dialogue)
 prompt = PromptTemplate(
@@ -25,54 +19,118 @@ prompt = PromptTemplate(
     #合理分句，单句应不超过20字！！
     #内容不应过少，可适当扩充对话，丰富人物形象，但应保证前后的连贯性。
     #并完成这个章节故事的地点的详细描述，如名称、地点、装饰、场景等等。（应有且仅有一个地点，若没有或原文不止一个，则自由发挥确保输出应有且仅有一个地点）
-    创作要求：{text}
-
     请严格按照以下格式输出,不要添加任何额外说明：：
     {format_instructions}
 
+    创作要求：{text}
+
     输出：""",
     input_variables=["text"],
     partial_variables={"format_instructions": parser.get_format_instructions()}
 
 )
 
-llm = llm_chat.LlmChat(
-    model_name='deepseek-reasoner',
-    temperature=1.5,
-    model_provider='openai',
-    base_url='https://api.deepseek.com',
-    api_key=const.api_key,
-    pydantic_object=Dialogue,
-    prompt_template=prompt
-)
-strict_model = False
-path = '2026-02-02 22_28_06.json'
-get_dialogue = tools.read_json_file(f'../data/complete_script/{path}')
-paragraph_num = get_dialogue['paragraph_num']
-content = get_dialogue['content']
-article_script_name = get_dialogue['article_script_name']
-for i in range(paragraph_num):
+
+def create_llm():
+    return llm_chat.LlmChat(
+        model_name='deepseek-reasoner',
+        temperature=1.5,
+        model_provider='openai',
+        base_url='https://api.deepseek.com',
+        api_key=const.api_key,
+        pydantic_object=Dialogue,
+        prompt_template=prompt
+    )
+
+
+def generate_dialogue(content: str, llm=None, strict_model: bool = False, index: int = None,
+                      **refine_options) -> Dialogue:
+    """把一段剧本写成对话形式台本，评价通过后转为结构化结果；index 仅用于记录是第几段，refine_options 见 refine.refine"""
+    llm = llm or create_llm()
     llm.change_temperature(1.5)
-    llm.new_message = ''
-    while True:
-        user_input = f'''根据剧本完成对话形式台本的创作，要求根据所给的内容输出作品的完整对话形式台本,
+    user_input = f'''根据剧本完成对话形式台本的创作，要求根据所给的内容输出作品的完整对话形式台本,
         形式如：【（说话者的名字，若是旁白则写‘旁白’） ： （该说话者说的内容）】
                【。。。】
                #合理分句，单句应不超过20字！！
                #内容不应过少，可适当扩充对话，丰富人物形象，但应保证前后的连贯性。
                #并完成这个章节故事的地点的详细描述，如名称、地点、装饰、场景等等。（应有且仅有一个地点，若没有或原文不止一个，则自由发挥确保输出应有且仅有一个地点）
-        以下为原剧本内容{content[i]}\n请根据原剧本内容创作'''
-        llm.singe_chat(user_input)
-        eva = llm.evaluate_result(llm.new_message, '对话形式台本')
-        if eva.res == "Perfect" or (eva.res == "Good" and not strict_model):
-            print(llm.new_message)
-            x = llm.new_message
-            llm.change_temperature(0.3)
-            result = llm.structured_chat(str(x)+'\n'+'以上为最终确定的对话形式台本，按我要求的格式输出剧本内容，不要剧本内容进行额外删改，也不要有多余内容')
-            tools.save_dict_to_json(result.model_dump(), f'../data/dialogue/{i}dialogue{path}')
-            break
-        else:
-            llm.singe_chat(
-                f'完成对话形式台本的修改。原对话形式台本:{llm.new_message}.\n用户原始要求（务必参考）{user_input}\n其他修改建议:{eva.reason_and_advise}')
+        以下为原剧本内容{content}\n请根据原剧本内容创作'''
+    x = refine.refine(
+        llm, user_input,
+        lambda draft, advise: f'{user_input}\n以上为用户原始要求（务必参考）。完成对话形式台本的修改。原对话形式台本:{draft}.\n其他修改建议:{advise}',
+        '对话形式台本', strict_model, prefix=user_input, name='get_dialogue', paragraph=index, **refine_options)
+    llm.change_temperature(0.3)
+    return llm.structured_chat(str(x)+'\n'+'以上为最终确定的对话形式台本，按我要求的格式输出剧本内容，不要剧本内容进行额外删改，也不要有多余内容')
+
+
+def generate_dialogues(contents: list[str], save, workers: int = DEFAULT_WORKERS, strict_model: bool = False,
+                       indices=None, llm_factory=None, **refine_options) -> dict[int, Dialogue]:
+    """
+    并发生成多段台本，参数与返回值见 generate_dialogue_stream
+    :param indices: 需要生成的段落序号，默认全部
+    """
+    indices = range(len(contents)) if indices is None else indices
+    return generate_dialogue_stream(((i, contents[i]) for i in indices), save, workers, strict_model, llm_factory,
+                                    **refine_options)
+
+
+def generate_dialogue_stream(paragraphs, save, workers: int = DEFAULT_WORKERS, strict_model: bool = False,
+                             llm_factory=None, **refine_options) -> dict[int, Dialogue]:
+    """
+    并发生成多段台本，每个工作线程持有自己的 LlmChat(对话状态不共享，客户端与限流器仍是共享的)
+    :param paragraphs: (段落序号, 剧本段落) 的可迭代对象，可以是边生成边产出的生成器，每拿到一段就交给工作线程
+    :param save: save(i, dialogue)，每段完成即调用，用于单独落盘
+    :param llm_factory: 创建每个线程所用 LlmChat 的函数，默认 create_llm
+    :param refine_options: 每段生成-评价循环的参数，见 refine.refine
+    :return: {段落序号: 台本}；有段落失败时，其余段落仍会完成并保存，最后抛出序号最小的那段的异常；
+             paragraphs 本身出错时取消尚未开始的段落，等在途的段落结束后抛出该异常
+    """
+    llm_factory = llm_factory or create_llm
+    local = threading.local()
+
+    def work(i, content):
+        if getattr(local, 'llm', None) is None:
+            local.llm = llm_factory()
+        dialogue = generate_dialogue(content, local.llm, strict_model, index=i, **refine_options)
+        save(i, dialogue)
+        return dialogue
+
+    results = {}
+    errors = {}
+    source_error = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        try:
+            for i, content in paragraphs:
+                futures[executor.submit(work, i, content)] = i
+        except Exception as e:
+            source_error = e
+            for future in futures:
+                future.cancel()
+        for future in as_completed(futures):
+            i = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                errors[i] = e
+                print(f"第{i}段台本生成失败：{type(e).__name__}: {e}", file=sys.stderr)
+    if source_error is not None:
+        raise source_error
+    if errors:
+        raise errors[min(errors)]
+    return dict(sorted(results.items()))
 
 
+if __name__ == "__main__":
+    strict_model = False
+    path = '2026-02-02 22_28_06.json'
+    script_path = f'../data/complete_script/{path}'
+    get_dialogue = tools.read_json_file(script_path, schema=ArticleCompleteScript)
+    # 已生成且不早于剧本的段落直接跳过，中断后重跑只补缺失的段落
+    pending = [i for i in range(len(get_dialogue.content))
+               if not tools.is_fresh(f'../data/dialogue/{i}dialogue{path}', [script_path])]
+    generate_dialogues(get_dialogue.content,
+                       lambda i, result: tools.save_dict_to_json(result.model_dump(), f'../data/dialogue/{i}dialogue{path}'),
+                       strict_model=strict_model, indices=pending)
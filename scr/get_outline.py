@@ -1,63 +1,224 @@
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import llm_chat
 import const
-from pydantic import BaseModel, Field
-from typing import Literal
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 import tools
+import refine
+import telemetry
+from schemas import ArticleOutline
 
+# 可选依赖：YAML 格式的任务文件需要 PyYAML，未安装时只支持 JSONL
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
-class ArticleOutline(BaseModel):
-    article_outline_name: str = Field(description="文章大纲的名字")
-    content: str = Field(description="文章大纲的内容")
+OUTLINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'outline')
+# 批量模式同时处理的任务数
+DEFAULT_BATCH_WORKERS = 4
+# 任务 id 用作文件名，只保留字母数字(含中文)、下划线与连字符
+JOB_ID_RE = re.compile(r'[^\w\-]+')
+# 任务中可单独覆盖的生成-评价循环参数
+JOB_REFINE_OPTIONS = ('candidates', 'max_rounds', 'token_budget')
 
 
 parser = PydanticOutputParser(pydantic_object=ArticleOutline)
 prompt = PromptTemplate(
     template="""你是一个作家。请根据所给的内容输出作品的大纲：
 
-    创作要求：{text}
-
     请严格按照以下格式输出,不要添加任何额外说明：：
     {format_instructions}
 
+    创作要求：{text}
+
     输出：""",
     input_variables=["text"],
     partial_variables={"format_instructions": parser.get_format_instructions()}
 )
 
-llm = llm_chat.LlmChat(
-    model_name='deepseek-reasoner',
-    temperature=1.5,
-    model_provider='openai',
-    base_url='https://api.deepseek.com',
-    api_key=const.api_key,
-    pydantic_object=ArticleOutline,
-    prompt_template=prompt
-)
 
-llm.new_message = ''
-# 完成一篇科幻小说的大纲
-strict_model = False
-while True:
-    user_input = input('input:')
-    if user_input == 'exit':
-        x = llm.new_message
-        result = llm.structured_chat(str(x)+'\n'+'以上为最终确定的大纲，按我要求的格式输出大纲的标题与内容，不要大纲内容进行删改，也不要有多余内容')
-        print(result)
-        tools.save_dict_to_json(result.model_dump(), f'../data/outline/{const.time_now_}.json')
-        break
+def create_llm():
+    return llm_chat.LlmChat(
+        model_name='deepseek-reasoner',
+        temperature=1.5,
+        model_provider='openai',
+        base_url='https://api.deepseek.com',
+        api_key=const.api_key,
+        pydantic_object=ArticleOutline,
+        prompt_template=prompt
+    )
+
+
+def draft_outline(llm, user_input: str, strict_model: bool = False, **refine_options) -> str:
+    """按用户要求完成或修改 llm.new_message 中的大纲，评价通过后返回大纲文本；refine_options 见 refine.refine"""
+    # 用户要求在前、稿件在后，修改轮与第一轮共用同一段前缀
+    request = f'完成或修改作品的大纲。用户要求:{user_input}.'
+    return refine.refine(
+        llm,
+        f'{request}\n原大纲:{llm.new_message}（可能为空，按用户要求完成大纲即可）',
+        lambda draft, advise: f'{request}\n以上为用户原始要求（务必参考）。完成文章大纲的修改。原大纲:{draft}.\n其他修改建议:{advise}',
+        '大纲', strict_model, prefix=request, name='get_outline', **refine_options)
+
+
+def finalize_outline(llm) -> ArticleOutline:
+    x = llm.new_message
+    return llm.structured_chat(str(x)+'\n'+'以上为最终确定的大纲，按我要求的格式输出大纲的标题与内容，不要大纲内容进行删改，也不要有多余内容')
+
+
+def generate_outline(user_input: str, llm=None, strict_model: bool = False, **refine_options) -> ArticleOutline:
+    """无交互地生成大纲：按要求写出并通过评价后，转为结构化结果"""
+    llm = llm or create_llm()
+    llm.new_message = ''
+    draft_outline(llm, user_input, strict_model, **refine_options)
+    return finalize_outline(llm)
+
+
+# -------------------------- 批量模式 --------------------------
+def load_jobs(job_path: str) -> list[dict]:
+    """
+    读取批量任务文件：.jsonl 每行一个任务；.yaml/.yml 为任务列表(或含 jobs 列表的对象)
+    任务可以直接是创作要求字符串，也可以是 {"id": ..., "requirement": ..., "strict": ..., "candidates": ...}，
+    缺少 id 时按序号命名为 job000、job001 ...
+    """
+    with open(job_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if job_path.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise ImportError("读取 YAML 任务文件需要安装 PyYAML：pip install pyyaml")
+        data = yaml.safe_load(text) or []
+        if isinstance(data, dict):
+            data = data.get('jobs', [])
     else:
-        llm.singe_chat(f'完成或修改作品的大纲。用户要求:{user_input}.\n原大纲:{llm.new_message}（可能为空，按用户要求完成大纲即可）')
-        while True:
-            eva = llm.evaluate_result(llm.new_message, '大纲')
-            if eva.res == "Perfect" or (eva.res == "Good" and not strict_model):
-                print(llm.new_message)
-                break
-            else:
-                llm.singe_chat(f'完成文章大纲的修改。原大纲:{llm.new_message}.\n用户原始要求（务必参考）{user_input}\n其他修改建议:{eva.reason_and_advise}')
+        data = [tools.loads_json(line) for line in text.splitlines() if line.strip()]
+
+    jobs = []
+    for n, job in enumerate(data):
+        if isinstance(job, str):
+            job = {'requirement': job}
+        if not isinstance(job, dict) or not job.get('requirement'):
+            raise ValueError(f"第{n + 1}个任务缺少 requirement：{job}")
+        job_id = JOB_ID_RE.sub('_', str(job.get('id') or f'job{n:03d}')).strip('_')
+        jobs.append({**job, 'id': job_id})
+    ids = [job['id'] for job in jobs]
+    duplicates = sorted({job_id for job_id in ids if ids.count(job_id) > 1})
+    if duplicates:
+        raise ValueError(f"任务 id 重复(会写入同一个文件)：{duplicates}")
+    return jobs
+
+
+def run_outline_batch(jobs: list[dict], out_dir: str = OUTLINE_DIR, workers: int = DEFAULT_BATCH_WORKERS,
+                      strict_model: bool = False, force: bool = False, llm_factory=None, **refine_options) -> dict:
+    """
+    在线程池中并发生成多个大纲，每个任务写出 out_dir/<id>.json；已存在的跳过(force 时重新生成)
+    每个工作线程持有自己的 LlmChat；单个任务失败不影响其他任务
+    :return: 汇总 {'done', 'skipped', 'failed', 'seconds', 'jobs': [每个任务的 id/状态/耗时/输出/错误]}
+    """
+    llm_factory = llm_factory or create_llm
+    local = threading.local()
+
+    def work(job):
+        output_path = os.path.join(out_dir, f"{job['id']}.json")
+        entry = {'id': job['id'], 'status': 'skipped', 'seconds': 0.0, 'output': output_path}
+        if not force and os.path.exists(output_path):
+            return entry
+        start = time.perf_counter()
+        try:
+            if getattr(local, 'llm', None) is None:
+                local.llm = llm_factory()
+            options = {**refine_options, **{key: job[key] for key in JOB_REFINE_OPTIONS if key in job}}
+            with telemetry.span('job', 'get_outline', job=job['id']):
+                outline = generate_outline(job['requirement'], local.llm, job.get('strict', strict_model), **options)
+            tools.save_dict_to_json(outline.model_dump(), output_path)
+            entry['status'] = 'done'
+        except Exception as e:
+            entry['status'] = 'failed'
+            entry['error'] = f"{type(e).__name__}: {e}"
+        entry['seconds'] = time.perf_counter() - start
+        return entry
+
+    summary = {'done': 0, 'skipped': 0, 'failed': 0, 'jobs': []}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(work, job) for job in jobs]
+        for future in as_completed(futures):
+            entry = future.result()
+            summary[entry['status']] += 1
+            summary['jobs'].append(entry)
+    summary['seconds'] = time.perf_counter() - start
+    order = {job['id']: n for n, job in enumerate(jobs)}
+    summary['jobs'].sort(key=lambda entry: order[entry['id']])
+    return summary
+
+
+def print_batch_summary(summary: dict) -> None:
+    total = summary['done'] + summary['skipped'] + summary['failed']
+    print(f"{total} jobs in {summary['seconds']:.1f}s: "
+          f"{summary['done']} done, {summary['skipped']} already present, {summary['failed']} failed")
+    for entry in summary['jobs']:
+        if entry['status'] == 'done':
+            print(f"  {entry['id']}: {entry['seconds']:.1f}s -> {entry['output']}")
+        elif entry['status'] == 'failed':
+            print(f"  FAILED {entry['id']} after {entry['seconds']:.1f}s: {entry['error']}")
+
+
+def run_interactive(strict_model: bool = False) -> None:
+    llm = create_llm()
+    llm.new_message = ''
+    # 完成一篇科幻小说的大纲
+    while True:
+        user_input = input('input:')
+        if user_input == 'exit':
+            result = finalize_outline(llm)
+            print(result)
+            tools.save_dict_to_json(result.model_dump(), f'../data/outline/{const.time_now_}.json')
+            break
+        else:
+            draft_outline(llm, user_input, strict_model)
 
 
+if __name__ == "__main__":
+    import argparse
 
+    arg_parser = argparse.ArgumentParser(description="Write story outlines. Interactive by default; "
+                                                     "--batch generates one outline per job without prompting.")
+    arg_parser.add_argument('--batch', metavar='JOB_FILE',
+                            help='JSONL (one job per line) or YAML job list; a job is a requirement string or '
+                                 'an object with "requirement" and optional "id", "strict", "candidates", '
+                                 '"max_rounds", "token_budget"')
+    arg_parser.add_argument('--out-dir', default=OUTLINE_DIR, help='batch output directory (default: data/outline)')
+    arg_parser.add_argument('--workers', type=int, default=DEFAULT_BATCH_WORKERS,
+                            help=f'batch jobs run concurrently (default: {DEFAULT_BATCH_WORKERS})')
+    arg_parser.add_argument('--force', action='store_true', help='batch: regenerate outlines that already exist')
+    arg_parser.add_argument('--strict', action='store_true', help='only accept outlines rated Perfect')
+    arg_parser.add_argument('--candidates', type=int, default=refine.DEFAULT_CANDIDATES,
+                            help=f'drafts generated and evaluated in parallel per round '
+                                 f'(default: {refine.DEFAULT_CANDIDATES})')
+    arg_parser.add_argument('--max-rounds', type=int, default=refine.DEFAULT_MAX_ROUNDS,
+                            help=f'give up revising after this many rounds and keep the best draft '
+                                 f'(default: {refine.DEFAULT_MAX_ROUNDS})')
+    arg_parser.add_argument('--token-budget', type=int, help='stop revising an outline once it has used this many tokens')
+    args = arg_parser.parse_args()
 
+    if not args.batch:
+        run_interactive(args.strict)
+        sys.exit(0)
 
+    if not os.path.exists(args.batch):
+        print(f"Error: File not found: {args.batch}")
+        sys.exit(1)
+    jobs = load_jobs(args.batch)
+    summary = run_outline_batch(jobs, args.out_dir, args.workers, args.strict, args.force,
+                                candidates=args.candidates, max_rounds=args.max_rounds,
+                                token_budget=args.token_budget)
+    print_batch_summary(summary)
+    # 每个任务的耗时与结果另存一份，便于事后比较
+    report_path = os.path.splitext(args.batch)[0] + '.report.json'
+    tools.save_dict_to_json(summary, report_path)
+    sys.exit(1 if summary['failed'] else 0)
@@ -1,33 +1,46 @@
 import tools
 import json_to_renpy
+from schemas import Dialogue
 
-list_src = []
-text = tools.read_json_file('../data/dialogue/0dialogue2026-02-02 22_28_06.json')
-site_description = text.get('site', '')
-name = text['chapter_name']
-text = text['dialogues']
 
-parent_id = ''
-children = []
-for i in range(len(text)):
-    if i != 0:
-        parent_id = str(i - 1)
-    if i != len(text) - 1:
-        children = [str(i + 1)]
+def build_dialogue_nodes(items) -> list[dict]:
+    """把对话列表串成一条线性的对话图：每句的 parent 为上一句，children 为下一句"""
+    list_src = []
+    parent_id = ''
+    children = []
+    for i in range(len(items)):
+        if i != 0:
+            parent_id = str(i - 1)
+        if i != len(items) - 1:
+            children = [str(i + 1)]
+        else:
+            children = []
+        x = {
+            "id": str(i),
+            "name": items[i].name,
+            "content": items[i].dialogue_content,
+            "branch_num": 1,
+            "parent_id": parent_id,
+            "children": children
+        }
+        list_src.append(x)
+    return list_src
+
+
+def build_dialogue_graph(dialogues: list[Dialogue], name: str = None) -> dict:
+    """多个章节按顺序首尾相连，合成一个 json_to_renpy 可以转换的对话图"""
+    items = [item for dialogue in dialogues for item in dialogue.dialogues]
+    if len(dialogues) == 1:
+        site_description = dialogues[0].site
     else:
-        children = []
-    x = {
-        "id": str(i),
-        "name": text[i]['name'],
-        "content": text[i]['dialogue_content'],
-        "branch_num": 1,
-        "parent_id": parent_id,
-        "children": children
-    }
-    list_src.append(x)
+        site_description = '\n'.join(f'{dialogue.chapter_name}：{dialogue.site}' for dialogue in dialogues)
+    return {"dialogue_name": name or dialogues[0].chapter_name, "site_description": site_description,
+            "dialogue_content": build_dialogue_nodes(items)}
+
 
-tools.save_dict_to_json({"dialogue_name": name, "site_description": site_description, "dialogue_content": list_src},
-                        '../resource/label2.json')
+if __name__ == "__main__":
+    text = tools.read_json_file('../data/dialogue/0dialogue2026-02-02 22_28_06.json', schema=Dialogue)
+    tools.save_dict_to_json(build_dialogue_graph([text]), '../resource/label2.json')
 
-# 自动转换为Ren'Py脚本
-json_to_renpy.convert_json_file('../resource/label2.json', '../resource/label2.rpy')
+    # 自动转换为Ren'Py脚本
+    json_to_renpy.convert_json_to_renpy('../resource/label2.json', '../resource/label2.rpy')
@@ -1,11 +1,19 @@
 from openai import OpenAI
 import const
 import base64
+import rate_limit
+import telemetry
 
+base_url = "https://api.siliconflow.cn/v1"
 client = OpenAI(
     api_key=const.siliconflow_api_key,
-    base_url="https://api.siliconflow.cn/v1"
+    base_url=base_url,
+    # 重试交给 rate_limit
+    max_retries=0,
 )
+limiter = rate_limit.limiter_for(base_url)
+# 一张图片按约 1500 token 预估 tpm 用量，调用后按实际用量修正
+IMAGE_TOKENS_ESTIMATE = 1500
 prompt = """
 请分析这张图片的内容
 """
@@ -44,24 +52,30 @@ def image_to_base64_url(img_path):
 # -------------------------- 3. 调用GLM-4.6V接口 --------------------------
 def analyse_image(img_path):
     img_base64_url = image_to_base64_url(img_path)
-    response = client.chat.completions.create(
-        model="zai-org/GLM-4.6V",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": img_base64_url  # 直接用Base64 Data URL替换原网络URL
-                        }
-                    },
-                ],
-            }
-        ],
-        max_tokens=300,
-    )
+    with telemetry.span('image', 'analyse_image', model="zai-org/GLM-4.6V"):
+        response = limiter.call(
+            client.chat.completions.create,
+            estimated_tokens=IMAGE_TOKENS_ESTIMATE + 300,
+            usage=lambda r: r.usage.total_tokens if r.usage else None,
+            on_retry=telemetry.note_retry,
+            model="zai-org/GLM-4.6V",
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": img_base64_url  # 直接用Base64 Data URL替换原网络URL
+                            }
+                        },
+                    ],
+                }
+            ],
+            max_tokens=300,
+        )
+        telemetry.add_openai_usage(response.usage)
 
     #print("模型回复：", response.choices[0].message.content)
     return response.choices[0].message.content
@@ -1,7 +1,31 @@
+import glob
+import hashlib
+import heapq
 import json
 import re
 import os
-from typing import Any
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Any, Iterable, Iterator
+
+from tools import dumps_json, loads_json
+
+WRITE_BUFFER_SIZE = 1 << 16
+# 生成逻辑变化时修改版本号，使旧的缓存失效(输入未变也会完整重新生成)
+INCREMENTAL_CACHE_VERSION = '1'
+# 增量模式的缓存放在输出旁；不用 .json 后缀，免得被批量模式当作输入
+INCREMENTAL_CACHE_SUFFIX = '.cache'
+# 缓存中每个节点摘要的十六进制字符数(摘要拼成一个字符串存放)
+DIGEST_CHARS = 16
+# 同样的 flag/资源字符串在节点间大量重复，解析结果做缓存
+PARSE_CACHE_SIZE = 1 << 16
+
+VARIABLE_NAME_RE = re.compile(r'^([a-zA-Z_][a-zA-Z0-9_]*)')
+NON_IDENTIFIER_RE = re.compile(r'[^a-zA-Z0-9_]')
+UNDERSCORES_RE = re.compile(r'_+')
 
 TRANSITION_MAP = {
     "fade": "fade",
@@ -37,64 +61,178 @@ def parse_flag_expression(expr: str) -> list[str]:
     return result
 
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_resource_tuple(value: str) -> tuple[str, ...]:
+    return tuple(parse_resource_field(value))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_flag_tuple(expr: str) -> tuple[str, ...]:
+    return tuple(parse_flag_expression(expr))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
 def extract_variable_name(expr: str) -> str:
-    match = re.match(r'^([a-zA-Z_][a-zA-Z0-9_]*)', expr.strip())
+    match = VARIABLE_NAME_RE.match(expr.strip())
     if match:
         return match.group(1)
     return None
 
 
-def extract_all_variables(dialogue_content: list[dict]) -> set[str]:
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def normalize_condition(condition: str) -> str:
+    cond_str = str(condition).strip()
+    if '=' in cond_str and '==' not in cond_str and '>=' not in cond_str and '<=' not in cond_str and '!=' not in cond_str:
+        cond_str = cond_str.replace('=', '==')
+    return cond_str
+
+
+def character_var_name(name: str, node_id: str) -> str:
+    var_name = NON_IDENTIFIER_RE.sub('_', name)
+    var_name = UNDERSCORES_RE.sub('_', var_name).strip('_')
+    if not var_name:
+        var_name = f"char_{node_id}"
+    return var_name
+
+
+def intern_id(value: Any) -> str:
+    return sys.intern(str(value))
+
+
+def intern_ids(values: Iterable[Any]) -> tuple[str, ...]:
+    return tuple(map(sys.intern, map(str, values)))
+
+
+class DialogueNode:
+    # 加载时一次性解析好的节点：id 为驻留字符串，children/menu/checkFlag/资源字段均已预解析
+    __slots__ = ('id', 'name', 'content', 'parent_id', 'children', 'menu', 'check_flag', 'set_flag',
+                 'background', 'character', 'music', 'sound', 'transition')
+
+    def __init__(self, node_id: str, name: str = '', content: str = '', parent_id: str = '',
+                 children: tuple[str, ...] = (), menu: tuple[tuple[str, tuple[str, ...]], ...] = (),
+                 check_flag: tuple[tuple[str, str], ...] = (), set_flag: tuple[str, ...] = (),
+                 background: tuple[str, ...] = (), character: tuple[str, ...] = (),
+                 music: tuple[str, ...] = (), sound: tuple[str, ...] = (), transition: str = None):
+        self.id = node_id
+        self.name = name
+        self.content = content
+        self.parent_id = parent_id
+        self.children = children
+        # menu: ((选项文本, 该选项的 flag 表达式), ...)
+        self.menu = menu
+        # check_flag: ((目标节点id, 已规范化的条件), ...)
+        self.check_flag = check_flag
+        self.set_flag = set_flag
+        self.background = background
+        self.character = character
+        self.music = music
+        self.sound = sound
+        self.transition = transition
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DialogueNode':
+        # 大多数节点只有少数字段，缺省字段直接用空元组，避免逐个解析
+        get = data.get
+        children = get('children')
+        menu = get('menu')
+        check_flag = get('checkFlag')
+        set_flag = get('setOrChangeFlag')
+        background = get('background')
+        character = get('character')
+        music = get('music')
+        sound = get('sound')
+        transition = get('transition')
+        parent_id = get('parent_id')
+        return cls(
+            intern_id(data['id']),
+            sys.intern(str(get('name') or '')),
+            get('content') or '',
+            intern_id(parent_id) if parent_id else '',
+            intern_ids(children) if children else (),
+            tuple((item.get('content', ''), parse_flag_tuple(str(item.get('flag') or '')))
+                  for item in menu) if menu else (),
+            tuple((intern_id(target_id), normalize_condition(str(condition)))
+                  for target_id, condition in check_flag.items()) if isinstance(check_flag, dict) else (),
+            parse_flag_tuple(str(set_flag)) if set_flag else (),
+            parse_resource_tuple(str(background)) if background else (),
+            parse_resource_tuple(str(character)) if character else (),
+            parse_resource_tuple(str(music)) if music else (),
+            parse_resource_tuple(str(sound)) if sound else (),
+            get_transition(str(transition)) if transition else None,
+        )
+
+
+def analyse_dialogue(dialogue_content: list[dict], assets: 'AssetRegistry' = None) -> dict:
+    # 单次遍历：解析节点，同时建立各类索引并收集变量、角色、资源和根节点
+    nodes = []
+    node_map = {}
+    children_map = {}
+    parent_map = {}
+    branch_targets = set()
     variables = set()
-    for node in dialogue_content:
-        if node.get('menu'):
-            for menu_item in node['menu']:
-                flag = menu_item.get('flag', '')
-                if flag:
-                    for expr in parse_flag_expression(flag):
-                        var_name = extract_variable_name(expr)
-                        if var_name:
-                            variables.add(var_name)
-        set_flag = node.get('setOrChangeFlag', '')
-        if set_flag:
-            for expr in parse_flag_expression(set_flag):
-                var_name = extract_variable_name(expr)
-                if var_name:
-                    variables.add(var_name)
-        check_flag = node.get('checkFlag', {})
-        if isinstance(check_flag, dict):
-            for condition in check_flag.values():
-                var_name = extract_variable_name(str(condition))
-                if var_name:
-                    variables.add(var_name)
-    return variables
-
-
-def extract_all_characters(dialogue_content: list[dict]) -> dict[str, str]:
     characters = {}
-    for node in dialogue_content:
-        name = node.get('name', '')
-        if name and name != '旁白':
-            var_name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
-            var_name = re.sub(r'_+', '_', var_name).strip('_')
-            if not var_name:
-                var_name = f"char_{node['id']}"
-            if name not in characters:
-                characters[name] = var_name
-    return characters
-
-
-def build_node_map(dialogue_content: list[dict]) -> dict[str, dict]:
-    return {node['id']: node for node in dialogue_content}
-
-
-def find_root_node(dialogue_content: list[dict]) -> str:
-    for node in dialogue_content:
-        if not node.get('parent_id'):
-            return node['id']
-    return '0'
+    root_id = None
+
+    for index, data in enumerate(dialogue_content):
+        # 加载时一次性校验：字段类型不对的节点在这里报错，生成阶段不再逐项检查
+        try:
+            node = DialogueNode.from_dict(data)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Invalid dialogue node #{index}: {type(e).__name__}: {e}") from e
+        node_id = node.id
+        nodes.append(node)
+        node_map[node_id] = node
+        children = node.children
+        children_map[node_id] = children
+
+        if root_id is None and not node.parent_id:
+            root_id = node_id
+
+        if len(children) == 1:
+            parent_map.setdefault(children[0], []).append(node_id)
+        elif children:
+            # 同一父节点重复列出同一子节点只算一次
+            for child_id in dict.fromkeys(children):
+                parent_map.setdefault(child_id, []).append(node_id)
+
+        name = node.name
+        if name and name != '旁白' and name not in characters:
+            characters[name] = character_var_name(name, node_id)
+
+        if assets is not None:
+            assets.add_node(node)
+
+        if node.menu:
+            branch_targets.update(get_menu_targets(node))
+            for _, flags in node.menu:
+                variables.update(extract_variable_name(expr) for expr in flags)
+        for target_id, condition in node.check_flag:
+            branch_targets.add(target_id)
+            variables.add(extract_variable_name(condition))
+        for expr in node.set_flag:
+            variables.add(extract_variable_name(expr))
+
+    variables.discard(None)
+    return {
+        'nodes': nodes,
+        'node_map': node_map,
+        'children_map': children_map,
+        'parent_map': parent_map,
+        'branch_targets': branch_targets,
+        'variables': variables,
+        'characters': characters,
+        'root_id': root_id if root_id is not None else '0',
+    }
+
+
+def get_menu_targets(node: DialogueNode) -> list[str]:
+    children = node.children
+    if not node.menu or not children:
+        return []
+    return [children[min(i, len(children) - 1)] for i in range(len(node.menu))]
 
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
 def get_transition(transition_value: str) -> str:
     if not transition_value:
         return None
@@ -102,43 +240,122 @@ def get_transition(transition_value: str) -> str:
     return TRANSITION_MAP.get(transition_value, transition_value)
 
 
-def generate_resource_commands(node: dict, indent: str = "    ") -> list[str]:
+class AssetRegistry:
+    # 全图共用的资源表：每个不同的资源文件只登记一次，预先算好 Ren'Py 中的图像标签；
+    # 路径统一为 / 分隔后再去重，bg/a.png 与 bg\a.png 视为同一个文件
+    IMAGE_PREFIXES = {'background': 'bg', 'character': 'char'}
+
+    def __init__(self, resource_dir: str = None):
+        self.resource_dir = resource_dir
+        self.images = {}
+        self.audio = {}
+        self._used_tags = set()
+        self._available = None
+
+    @classmethod
+    def from_images(cls, images: list, resource_dir: str = None) -> 'AssetRegistry':
+        # 按 [[类别, 路径, 标签], ...] 恢复图像表(增量模式的缓存)，标签保持不变
+        registry = cls(resource_dir)
+        for kind, path, tag in images:
+            registry.images[(kind, path)] = tag
+            registry._used_tags.add(tag)
+        return registry
+
+    def add_image(self, kind: str, path: str) -> str:
+        key = (kind, normalize_asset_path(path))
+        tag = self.images.get(key)
+        if tag is None:
+            tag = self._make_tag(self.IMAGE_PREFIXES[kind], key[1])
+            self.images[key] = tag
+        return tag
+
+    def add_audio(self, kind: str, path: str) -> None:
+        self.audio.setdefault(normalize_asset_path(path), kind)
+
+    def add_node(self, node: DialogueNode) -> None:
+        for path in node.background:
+            self.add_image('background', path)
+        for path in node.character:
+            self.add_image('character', path)
+        for path in node.music:
+            self.add_audio('music', path)
+        for path in node.sound:
+            self.add_audio('sound', path)
+
+    def tag(self, kind: str, path: str) -> str:
+        return self.images[(kind, normalize_asset_path(path))]
+
+    def _make_tag(self, prefix: str, path: str) -> str:
+        stem = os.path.splitext(path)[0]
+        stem = UNDERSCORES_RE.sub('_', NON_IDENTIFIER_RE.sub('_', stem)).strip('_') or 'asset'
+        tag = f"{prefix}_{stem}"
+        # 不同路径清洗后可能同名(如 a.png 与 a.jpg)，追加序号区分
+        suffix = 2
+        unique = tag
+        while unique in self._used_tags:
+            unique = f"{tag}_{suffix}"
+            suffix += 1
+        self._used_tags.add(unique)
+        return unique
+
+    def available_files(self) -> set[str]:
+        # 对资源目录只做一次遍历，之后的存在性检查都是集合查询
+        if self._available is None:
+            self._available = set()
+            if self.resource_dir:
+                for root, _, files in os.walk(self.resource_dir):
+                    rel_root = os.path.relpath(root, self.resource_dir)
+                    for name in files:
+                        rel_path = name if rel_root == '.' else os.path.join(rel_root, name)
+                        self._available.add(normalize_asset_path(rel_path))
+        return self._available
+
+    def missing(self) -> list[str]:
+        if not self.resource_dir:
+            return []
+        available = self.available_files()
+        paths = [path for _, path in self.images] + list(self.audio)
+        return [path for path in dict.fromkeys(paths) if path not in available]
+
+    def header_lines(self) -> list[str]:
+        lines = []
+        if self.images:
+            lines.append("# Images")
+            for (_, path), tag in self.images.items():
+                lines.append(f'image {tag} = "{path}"')
+            lines.append("")
+        return lines
+
+
+def normalize_asset_path(path: str) -> str:
+    return path.replace('\\', '/')
+
+
+def generate_resource_commands(node: DialogueNode, assets: AssetRegistry, indent: str = "    ") -> list[str]:
     lines = []
-    bg = node.get('background', '')
-    char = node.get('character', '')
-    music = node.get('music', '')
-    sound = node.get('sound', '')
-    transition = get_transition(node.get('transition', ''))
-
-    if bg:
-        bg_paths = parse_resource_field(bg)
-        for path in bg_paths:
-            trans_str = f" with {transition}" if transition else ""
-            lines.append(f"{indent}scene bg_{path.replace('/', '_').replace('\\\\', '_')}{trans_str}")
-
-    if char:
-        char_paths = parse_resource_field(char)
-        for i, path in enumerate(char_paths):
-            position = "at center" if i == 0 else f"at position_{i}"
-            lines.append(f"{indent}show char_{path.replace('/', '_').replace('\\\\', '_')} {position}")
-
-    if music:
-        music_paths = parse_resource_field(music)
-        for path in music_paths:
-            lines.append(f'{indent}play music "{path}"')
-
-    if sound:
-        sound_paths = parse_resource_field(sound)
-        for path in sound_paths:
-            lines.append(f'{indent}play sound "{path}"')
+    transition = node.transition
+
+    for path in node.background:
+        trans_str = f" with {transition}" if transition else ""
+        lines.append(f"{indent}scene {assets.tag('background', path)}{trans_str}")
+
+    for i, path in enumerate(node.character):
+        position = "at center" if i == 0 else f"at position_{i}"
+        lines.append(f"{indent}show {assets.tag('character', path)} {position}")
+
+    for path in node.music:
+        lines.append(f'{indent}play music "{path}"')
+
+    for path in node.sound:
+        lines.append(f'{indent}play sound "{path}"')
 
     return lines
 
 
-def generate_dialogue_line(node: dict, characters: dict[str, str], indent: str = "    ") -> list[str]:
+def generate_dialogue_line(node: DialogueNode, characters: dict[str, str], indent: str = "    ") -> list[str]:
     lines = []
-    name = node.get('name', '')
-    content = node.get('content', '')
+    name = node.name
+    content = node.content
 
     if not content:
         return lines
@@ -152,57 +369,36 @@ def generate_dialogue_line(node: dict, characters: dict[str, str], indent: str =
     return lines
 
 
-def generate_set_flag(node: dict, indent: str = "    ") -> list[str]:
-    lines = []
-    set_flag = node.get('setOrChangeFlag', '')
-    if set_flag:
-        for expr in parse_flag_expression(set_flag):
-            lines.append(f"{indent}$ {expr}")
-    return lines
+def generate_set_flag(node: DialogueNode, indent: str = "    ") -> list[str]:
+    return [f"{indent}$ {expr}" for expr in node.set_flag]
 
 
-def generate_menu_block(node: dict, node_map: dict, characters: dict, indent: str = "    ") -> list[str]:
+def generate_menu_block(node: DialogueNode, node_map: dict, characters: dict, indent: str = "    ") -> list[str]:
     lines = []
-    menu_items = node.get('menu', [])
-    children = node.get('children', [])
+    children = node.children
 
-    if not menu_items:
+    if not node.menu:
         return lines
 
     lines.append(f"{indent}menu:")
 
-    for i, item in enumerate(menu_items):
-        content = item.get('content', '')
-        flag = item.get('flag', '')
-
+    for i, (content, flags) in enumerate(node.menu):
         lines.append(f'{indent}    "{content}":')
 
-        if flag:
-            for expr in parse_flag_expression(flag):
-                lines.append(f"{indent}        $ {expr}")
+        for expr in flags:
+            lines.append(f"{indent}        $ {expr}")
 
         if children:
-            target_id = children[0] if len(children) == 1 else children[min(i, len(children) - 1)]
+            target_id = children[min(i, len(children) - 1)]
             lines.append(f"{indent}        jump label_{target_id}")
 
     return lines
 
 
-def generate_check_flag_block(node: dict, node_map: dict, indent: str = "    ") -> list[str]:
+def generate_check_flag_block(node: DialogueNode, node_map: dict, indent: str = "    ") -> list[str]:
     lines = []
-    check_flag = node.get('checkFlag', {})
 
-    if not isinstance(check_flag, dict) or not check_flag:
-        return lines
-
-    conditions = []
-    for node_id, condition in check_flag.items():
-        cond_str = str(condition).strip()
-        if '=' in cond_str and '==' not in cond_str and '>=' not in cond_str and '<=' not in cond_str and '!=' not in cond_str:
-            cond_str = cond_str.replace('=', '==')
-        conditions.append((cond_str, node_id))
-
-    for i, (cond, node_id) in enumerate(conditions):
+    for i, (node_id, cond) in enumerate(node.check_flag):
         if i == 0:
             lines.append(f"{indent}if {cond}:")
         else:
@@ -212,16 +408,49 @@ def generate_check_flag_block(node: dict, node_map: dict, indent: str = "    ")
     return lines
 
 
+def generate_node_lines(node: DialogueNode, characters: dict[str, str], assets: AssetRegistry,
+                        node_map: dict = None, indent: str = "    ") -> list[str]:
+    # 单个节点生成的行只取决于节点本身、角色表和资源表，增量模式据此单独重新生成改动的节点
+    lines = []
+
+    resource_lines = generate_resource_commands(node, assets, indent)
+    lines.extend(resource_lines)
+
+    dialogue_lines = generate_dialogue_line(node, characters, indent)
+    lines.extend(dialogue_lines)
+
+    set_flag_lines = generate_set_flag(node, indent)
+    lines.extend(set_flag_lines)
+
+    if node.menu:
+        menu_lines = generate_menu_block(node, node_map, characters, indent)
+        lines.extend(menu_lines)
+        return lines
+
+    if node.check_flag:
+        check_lines = generate_check_flag_block(node, node_map, indent)
+        lines.extend(check_lines)
+        return lines
+
+    return lines
+
+
 class RenPyGenerator:
-    def __init__(self, dialogue_data: dict):
-        self.dialogue_data = dialogue_data
-        self.dialogue_content = dialogue_data.get('dialogue_content', [])
+    def __init__(self, dialogue_data: dict, resource_dir: str = None):
+        # 只保留解析后的节点，原始 JSON 字典可随调用方释放
+        self.assets = AssetRegistry(resource_dir)
+        analysis = analyse_dialogue(dialogue_data.get('dialogue_content', []), self.assets)
+        self.dialogue_content = analysis['nodes']
         self.dialogue_name = dialogue_data.get('dialogue_name', 'dialogue')
-        self.node_map = build_node_map(self.dialogue_content)
-        self.variables = extract_all_variables(self.dialogue_content)
-        self.characters = extract_all_characters(self.dialogue_content)
+        self.node_map = analysis['node_map']
+        self.children_map = analysis['children_map']
+        self.parent_map = analysis['parent_map']
+        self.in_degree = {node_id: len(parents) for node_id, parents in self.parent_map.items()}
+        self.branch_targets = analysis['branch_targets']
+        self.variables = analysis['variables']
+        self.characters = analysis['characters']
         self.generated_labels = set()
-        self.root_id = find_root_node(self.dialogue_content)
+        self.root_id = analysis['root_id']
 
     def generate_header(self) -> list[str]:
         lines = []
@@ -241,150 +470,205 @@ class RenPyGenerator:
                 lines.append(f'define {var} = Character("{name}")')
             lines.append("")
 
+        lines.extend(self.assets.header_lines())
+
         return lines
 
-    def is_branching_node(self, node: dict) -> bool:
-        return bool(node.get('menu')) or bool(node.get('checkFlag'))
+    def is_branching_node(self, node: DialogueNode) -> bool:
+        return bool(node.menu) or bool(node.check_flag)
 
     def is_merge_point(self, node_id: str) -> bool:
-        parents = [n for n in self.dialogue_content if node_id in n.get('children', [])]
-        return len(parents) > 1
+        # 根节点另有 label start 这一入口，有回边指向它时同样需要独立标签
+        entries = self.in_degree.get(node_id, 0) + (1 if node_id == self.root_id else 0)
+        return entries > 1
 
     def generate_node_content(self, node_id: str, indent: str = "    ") -> list[str]:
-        lines = []
         node = self.node_map.get(node_id)
         if not node:
-            return lines
-
-        resource_lines = generate_resource_commands(node, indent)
-        lines.extend(resource_lines)
-
-        dialogue_lines = generate_dialogue_line(node, self.characters, indent)
-        lines.extend(dialogue_lines)
-
-        set_flag_lines = generate_set_flag(node, indent)
-        lines.extend(set_flag_lines)
-
-        if node.get('menu'):
-            menu_lines = generate_menu_block(node, self.node_map, self.characters, indent)
-            lines.extend(menu_lines)
-            return lines
-
-        if node.get('checkFlag'):
-            check_lines = generate_check_flag_block(node, self.node_map, indent)
-            lines.extend(check_lines)
-            return lines
-
-        return lines
+            return []
+        return generate_node_lines(node, self.characters, self.assets, self.node_map, indent)
 
-    def generate_linear_chain(self, start_id: str, indent: str = "    ") -> list[str]:
-        lines = []
+    def iter_chain_blocks(self, start_id: str, indent: str = "    ") -> Iterator[tuple[str, list[str]]]:
+        # 按节点分组产出 (节点id, 该节点生成的行)；jump/return 等结构行的节点id为 None
         current_id = start_id
 
         while current_id:
-            if current_id in self.generated_labels:
-                break
-
             node = self.node_map.get(current_id)
             if not node:
                 break
 
-            if self.is_branching_node(node) or self.is_merge_point(current_id):
-                lines.append(f"{indent}jump label_{current_id}")
+            # 分支/合并点以及菜单、checkFlag 的跳转目标都有独立标签，链在此处跳转过去；
+            # 须先于 generated_labels 判断，否则回到已生成的标签(环)时会直接断开而不跳转
+            if self.needs_label(current_id):
+                yield None, [f"{indent}jump label_{current_id}"]
+                break
+
+            if current_id in self.generated_labels:
                 break
 
             self.generated_labels.add(current_id)
 
-            content_lines = self.generate_node_content(current_id, indent)
-            lines.extend(content_lines)
+            yield current_id, self.generate_node_content(current_id, indent)
 
-            children = node.get('children', [])
+            children = self.children_map.get(current_id, [])
             if len(children) == 0:
-                lines.append(f"{indent}return")
+                yield None, [f"{indent}return"]
                 break
             elif len(children) == 1:
                 current_id = children[0]
             else:
                 break
 
-        return lines
+    def iter_linear_chain(self, start_id: str, indent: str = "    ") -> Iterator[str]:
+        for _, lines in self.iter_chain_blocks(start_id, indent):
+            yield from lines
 
-    def generate_branch_label(self, node_id: str) -> list[str]:
-        lines = []
+    def generate_linear_chain(self, start_id: str, indent: str = "    ") -> list[str]:
+        return list(self.iter_linear_chain(start_id, indent))
 
+    def iter_label_blocks(self, node_id: str) -> Iterator[tuple[str, list[str]]]:
         if node_id in self.generated_labels:
-            return lines
+            return
 
         self.generated_labels.add(node_id)
         node = self.node_map.get(node_id)
         if not node:
-            return lines
+            return
 
-        lines.append(f"label label_{node_id}:")
+        yield None, [f"label label_{node_id}:"]
 
-        content_lines = self.generate_node_content(node_id, "    ")
-        lines.extend(content_lines)
+        yield node_id, self.generate_node_content(node_id, "    ")
 
         if self.is_branching_node(node):
             pass
         else:
-            children = node.get('children', [])
+            children = self.children_map.get(node_id, [])
             if len(children) == 1:
-                chain_lines = self.generate_linear_chain(children[0], "    ")
-                lines.extend(chain_lines)
+                yield from self.iter_chain_blocks(children[0], "    ")
             elif len(children) == 0:
-                lines.append("    return")
+                yield None, ["    return"]
 
-        return lines
-
-    def collect_branch_nodes(self) -> list[str]:
-        branch_nodes = set()
+    def iter_branch_label(self, node_id: str) -> Iterator[str]:
+        for _, lines in self.iter_label_blocks(node_id):
+            yield from lines
 
-        for node_id, node in self.node_map.items():
-            if self.is_branching_node(node):
-                branch_nodes.add(node_id)
-            elif self.is_merge_point(node_id):
-                branch_nodes.add(node_id)
-
-            if node.get('menu'):
-                for item in node['menu']:
-                    pass
+    def generate_branch_label(self, node_id: str) -> list[str]:
+        return list(self.iter_branch_label(node_id))
 
-            check_flag = node.get('checkFlag', {})
-            if isinstance(check_flag, dict):
-                for target_id in check_flag.keys():
-                    branch_nodes.add(target_id)
+    def needs_label(self, node_id: str) -> bool:
+        node = self.node_map.get(node_id)
+        if not node:
+            return False
+        return self.is_branching_node(node) or self.is_merge_point(node_id) or node_id in self.branch_targets
+
+    def successors(self, node_id: str) -> Iterator[str]:
+        node = self.node_map[node_id]
+        yield from node.children
+        for target_id, _ in node.check_flag:
+            yield target_id
+
+    def reachable_order(self) -> list[str]:
+        # 先从根节点遍历得到可达节点及其发现顺序
+        discovery = {self.root_id: 0} if self.root_id in self.node_map else {}
+        queue = deque(discovery)
+        while queue:
+            node_id = queue.popleft()
+            for next_id in self.successors(node_id):
+                if next_id not in discovery and next_id in self.node_map:
+                    discovery[next_id] = len(discovery)
+                    queue.append(next_id)
+
+        # 在可达子图上做拓扑排序，同层按发现顺序；遇到环时取发现顺序最早的剩余节点断环
+        pending = dict.fromkeys(discovery, 0)
+        for node_id in discovery:
+            for next_id in dict.fromkeys(self.successors(node_id)):
+                if next_id in pending:
+                    pending[next_id] += 1
+
+        by_discovery = list(discovery)
+        ready = [discovery[node_id] for node_id, count in pending.items() if count == 0]
+        heapq.heapify(ready)
+        order = []
+        emitted = set()
+        cursor = 0
+        while len(order) < len(by_discovery):
+            if not ready:
+                while by_discovery[cursor] in emitted:
+                    cursor += 1
+                ready.append(cursor)
+            node_id = by_discovery[heapq.heappop(ready)]
+            if node_id in emitted:
+                continue
+            emitted.add(node_id)
+            order.append(node_id)
+            for next_id in dict.fromkeys(self.successors(node_id)):
+                if next_id in pending and next_id not in emitted:
+                    pending[next_id] -= 1
+                    if pending[next_id] == 0:
+                        heapq.heappush(ready, discovery[next_id])
+        return order
 
-        return list(branch_nodes)
+    def collect_branch_nodes(self) -> list[str]:
+        # 顺序确定(与哈希种子无关)，不可达的标签直接剔除
+        return [node_id for node_id in self.reachable_order() if self.needs_label(node_id)]
+
+    def iter_blocks(self) -> Iterator[tuple[str, list[str]]]:
+        # 按生成顺序产出 (节点id, 行)；增量模式据此记录每个节点的内容在输出中的位置
+        yield None, self.generate_header()
+
+        yield None, ["label start:"]
+        yield from self.iter_chain_blocks(self.root_id, "    ")
+        yield None, [""]
+
+        for node_id in self.collect_branch_nodes():
+            emitted = False
+            for block in self.iter_label_blocks(node_id):
+                emitted = True
+                yield block
+            if emitted:
+                yield None, [""]
+
+    def iter_lines(self) -> Iterator[str]:
+        # 按生成顺序逐行产出，不在内存中保留整份脚本
+        for _, lines in self.iter_blocks():
+            yield from lines
 
     def generate(self) -> str:
-        all_lines = []
+        return "\n".join(self.iter_lines())
+
+    def write(self, output_path: str, buffer_size: int = WRITE_BUFFER_SIZE) -> int:
+        line_count = 0
+        with open(output_path, 'w', encoding='utf-8', buffering=buffer_size) as f:
+            for line in self.iter_lines():
+                # 与 generate() 的 "\n".join 输出逐字节一致：末行不带换行
+                f.write(line if line_count == 0 else "\n" + line)
+                line_count += 1
+        return line_count
 
-        header = self.generate_header()
-        all_lines.extend(header)
 
-        all_lines.append("label start:")
+def load_dialogue_json(json_path: str) -> dict:
+    # 二进制读取后交给 tools.loads_json：装了 orjson 就用 orjson，否则回退标准库
+    with open(json_path, 'rb') as f:
+        return parse_dialogue_json(f.read(), json_path)
 
-        main_lines = self.generate_linear_chain(self.root_id, "    ")
-        all_lines.extend(main_lines)
 
-        all_lines.append("")
+def parse_dialogue_json(data: bytes, json_path: str) -> dict:
+    dialogue_data = loads_json(data)
+    if not isinstance(dialogue_data, dict) or not isinstance(dialogue_data.get('dialogue_content', []), list):
+        raise ValueError(f"Invalid dialogue JSON (expected an object with a dialogue_content list): {json_path}")
+    return dialogue_data
 
-        branch_nodes = self.collect_branch_nodes()
-        for node_id in branch_nodes:
-            label_lines = self.generate_branch_label(node_id)
-            if label_lines:
-                all_lines.extend(label_lines)
-                all_lines.append("")
 
-        return "\n".join(all_lines)
+def warn_missing_assets(generator: RenPyGenerator) -> None:
+    for path in generator.assets.missing():
+        print(f"Warning: asset not found in {generator.assets.resource_dir}: {path}", file=sys.stderr)
 
 
-def convert_json_to_renpy(json_path: str, output_path: str = None) -> str:
-    with open(json_path, 'r', encoding='utf-8') as f:
-        dialogue_data = json.load(f)
+def convert_json_to_renpy(json_path: str, output_path: str = None, resource_dir: str = None) -> str:
+    dialogue_data = load_dialogue_json(json_path)
 
-    generator = RenPyGenerator(dialogue_data)
+    generator = RenPyGenerator(dialogue_data, resource_dir)
+    warn_missing_assets(generator)
     renpy_script = generator.generate()
 
     if output_path:
@@ -394,24 +678,294 @@ def convert_json_to_renpy(json_path: str, output_path: str = None) -> str:
     return renpy_script
 
 
-if __name__ == "__main__":
-    import sys
+def stream_json_to_renpy(json_path: str, output_path: str, resource_dir: str = None) -> int:
+    generator = RenPyGenerator(load_dialogue_json(json_path), resource_dir)
+    warn_missing_assets(generator)
+    return generator.write(output_path)
+
 
-    if len(sys.argv) < 2:
-        print("Usage: python main.py <json_file> [output_file]")
-        print("Example: python main.py dialogue.json output.rpy")
+def short_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=DIGEST_CHARS // 2).hexdigest()
+
+
+def split_digests(joined: str) -> list[str]:
+    return [joined[i:i + DIGEST_CHARS] for i in range(0, len(joined), DIGEST_CHARS)]
+
+
+def header_digest(dialogue_data: dict) -> str:
+    return short_digest(dumps_json({key: value for key, value in dialogue_data.items() if key != 'dialogue_content'}))
+
+
+def node_shape_digest(node: Any) -> str:
+    # 去掉台词后的摘要：台词只影响该节点自己的那几行，不影响标签结构、角色、变量和资源
+    if isinstance(node, dict):
+        node = {**node, 'content': None}
+    return short_digest(dumps_json(node))
+
+
+def write_with_layout(generator: RenPyGenerator, output_path: str) -> list[int]:
+    """
+    与 RenPyGenerator.write 输出逐字节一致，同时按输出顺序记录每段内容的来源与字节数
+    :return: 扁平的 [节点序号, 字节数, 节点序号, 字节数, ...]；标签、跳转等结构行合并记为 -1
+    """
+    index_of = {node.id: index for index, node in enumerate(generator.dialogue_content)}
+    layout = []
+    line_count = 0
+    with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        for node_id, lines in generator.iter_blocks():
+            chunk = b''
+            if lines:
+                text = "\n".join(lines)
+                chunk = (text if line_count == 0 else "\n" + text).encode('utf-8')
+                line_count += len(lines)
+                f.write(chunk)
+            index = -1 if node_id is None else index_of[node_id]
+            if index < 0 and layout and layout[-2] < 0:
+                layout[-1] += len(chunk)
+            else:
+                layout += (index, len(chunk))
+    return layout
+
+
+def render_changed_nodes(cache: dict, dialogue_data: dict, digests: list[str]) -> dict[int, bytes]:
+    """
+    对比缓存中每个节点的摘要，重新生成只改了台词(content)的节点
+    :return: {节点序号: 该节点在输出中的新内容}；标题、结构、角色、变量或资源有改动时返回 None
+    """
+    dialogue_content = dialogue_data.get('dialogue_content', [])
+    previous = split_digests(cache['digests'])
+    if cache['header'] != header_digest(dialogue_data) or len(previous) != len(digests):
+        return None
+    changed = [index for index, (old, new) in enumerate(zip(previous, digests)) if old != new]
+    shapes = cache['shapes']
+    if any(shapes[index * DIGEST_CHARS:(index + 1) * DIGEST_CHARS] != node_shape_digest(dialogue_content[index])
+           for index in changed):
+        return None
+
+    # 其余字段都没变，角色表和图像标签与上次完整生成时相同
+    assets = AssetRegistry.from_images(cache['images'])
+    segments = {}
+    for index in changed:
+        lines = generate_node_lines(DialogueNode.from_dict(dialogue_content[index]), cache['characters'], assets)
+        # 节点内容前总有文件头，每段都以换行开头
+        segments[index] = ("\n" + "\n".join(lines)).encode('utf-8') if lines else b''
+    return segments
+
+
+def patch_output(output_path: str, layout: list[int], segments: dict[int, bytes]) -> bool:
+    # 按 layout 从上次的输出中原样复制未改动的部分；输出与 layout 对不上(如被手动修改过)时返回 False
+    with open(output_path, 'rb') as f:
+        previous = memoryview(f.read())
+    if sum(layout[1::2]) != len(previous):
+        return False
+
+    tmp_path = output_path + '.tmp'
+    position = copied = 0
+    with open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        for i in range(0, len(layout), 2):
+            length = layout[i + 1]
+            segment = segments.get(layout[i])
+            if segment is not None:
+                f.write(previous[copied:position])
+                f.write(segment)
+                layout[i + 1] = len(segment)
+                copied = position + length
+            position += length
+        f.write(previous[copied:])
+    os.replace(tmp_path, output_path)
+    return True
+
+
+def read_cache_stamp(cache_path: str) -> str:
+    # 缓存首行为 "<版本> <输入文件摘要>"，输入未变时只读这一行即可跳过
+    try:
+        with open(cache_path, 'rb') as f:
+            return f.readline().decode('utf-8', 'replace').strip()
+    except OSError:
+        return None
+
+
+def load_incremental_cache(cache_path: str) -> dict:
+    try:
+        with open(cache_path, 'rb') as f:
+            stamp = f.readline().decode('utf-8', 'replace').split()
+            cache = loads_json(f.read())
+    except (OSError, ValueError):
+        return None
+    if not stamp or stamp[0] != INCREMENTAL_CACHE_VERSION or not isinstance(cache, dict):
+        return None
+    return cache
+
+
+def save_incremental_cache(cache_path: str, source: str, cache: dict) -> None:
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(f"{INCREMENTAL_CACHE_VERSION} {source}\n".encode('utf-8'))
+        f.write(dumps_json(cache))
+    os.replace(tmp_path, cache_path)
+
+
+def incremental_json_to_renpy(json_path: str, output_path: str, cache_path: str = None,
+                              resource_dir: str = None) -> dict:
+    """
+    增量生成：输出旁的缓存记录每个节点的摘要及其内容在输出中的位置，只改了台词的节点单独重新生成，
+    其余内容从上次的输出中原样复制；标题、结构、角色、变量或资源有改动时退回完整生成并重建缓存
+    :return: {'mode': 'unchanged' / 'patched' / 'full', 'nodes': 重新生成的节点数}
+    """
+    cache_path = cache_path or output_path + INCREMENTAL_CACHE_SUFFIX
+    with open(json_path, 'rb') as f:
+        data = f.read()
+    source = short_digest(data)
+    if not os.path.exists(output_path):
+        cache = None
+    elif read_cache_stamp(cache_path) == f"{INCREMENTAL_CACHE_VERSION} {source}":
+        return {'mode': 'unchanged', 'nodes': 0}
+    else:
+        cache = load_incremental_cache(cache_path)
+
+    dialogue_data = parse_dialogue_json(data, json_path)
+    dialogue_content = dialogue_data.get('dialogue_content', [])
+    digests = [short_digest(dumps_json(node)) for node in dialogue_content]
+    # 先删掉旧缓存再改输出：中途失败时下次直接完整生成，不会拿旧的 layout 去切新的输出
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    segments = render_changed_nodes(cache, dialogue_data, digests) if cache is not None else None
+    if segments is not None and patch_output(output_path, cache['layout'], segments):
+        cache['digests'] = ''.join(digests)
+        save_incremental_cache(cache_path, source, cache)
+        return {'mode': 'patched', 'nodes': len(segments)}
+
+    generator = RenPyGenerator(dialogue_data, resource_dir)
+    warn_missing_assets(generator)
+    layout = write_with_layout(generator, output_path + '.tmp')
+    os.replace(output_path + '.tmp', output_path)
+    save_incremental_cache(cache_path, source, {
+        'header': header_digest(dialogue_data),
+        'digests': ''.join(digests),
+        'shapes': ''.join(node_shape_digest(node) for node in dialogue_content),
+        'layout': layout,
+        'characters': generator.characters,
+        'images': [[kind, path, tag] for (kind, path), tag in generator.assets.images.items()],
+    })
+    return {'mode': 'full', 'nodes': len(dialogue_content)}
+
+
+def expand_batch_inputs(pattern: str) -> list[str]:
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.json')
+    return sorted(glob.glob(pattern))
+
+
+def batch_output_path(json_path: str, output_dir: str = None) -> str:
+    stem = os.path.splitext(os.path.basename(json_path))[0]
+    return os.path.join(output_dir or os.path.dirname(json_path), stem + '.rpy')
+
+
+def convert_batch_item(json_path: str, output_path: str, force: bool = False,
+                       resource_dir: str = None) -> tuple[str, str, int, str]:
+    # 在子进程中运行：返回 (输入路径, 状态, 输出字节数, 错误信息)
+    tmp_path = output_path + '.tmp'
+    try:
+        if not force and os.path.exists(output_path) \
+                and os.path.getmtime(output_path) >= os.path.getmtime(json_path):
+            return json_path, 'skipped', 0, ''
+        # 批量模式只按 mtime 跳过，不在输出目录留下摘要等附属文件
+        stream_json_to_renpy(json_path, tmp_path, resource_dir)
+        os.replace(tmp_path, output_path)
+        return json_path, 'converted', os.path.getsize(output_path), ''
+    except Exception as e:
+        # 写到一半失败时删掉残缺的临时文件
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return json_path, 'failed', 0, f"{type(e).__name__}: {e}"
+
+
+def convert_batch(json_paths: list[str], output_dir: str = None, workers: int = None, force: bool = False,
+                  resource_dir: str = None) -> dict:
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    summary = {'converted': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'errors': {}}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_batch_item, path, batch_output_path(path, output_dir), force, resource_dir)
+                   for path in json_paths]
+        for future in as_completed(futures):
+            json_path, status, size, error = future.result()
+            summary[status] += 1
+            summary['bytes'] += size
+            if error:
+                summary['errors'][json_path] = error
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def print_batch_summary(summary: dict) -> None:
+    seconds = summary['seconds'] or 1e-9
+    total = summary['converted'] + summary['skipped'] + summary['failed']
+    print(f"{total} files in {summary['seconds']:.2f}s: "
+          f"{summary['converted']} converted, {summary['skipped']} up to date, {summary['failed']} failed")
+    print(f"Throughput: {summary['converted'] / seconds:.1f} files/s, "
+          f"{summary['bytes'] / seconds / (1 << 20):.2f} MiB/s written")
+    for json_path, error in sorted(summary['errors'].items()):
+        print(f"  FAILED {json_path}: {error}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Convert dialogue JSON to a Ren'Py script.")
+    arg_parser.add_argument('json_file', nargs='?')
+    arg_parser.add_argument('output_file', nargs='?')
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='only regenerate nodes whose dialogue text changed since the last run')
+    arg_parser.add_argument('--cache', help=f'incremental cache path (default: <output_file>{INCREMENTAL_CACHE_SUFFIX})')
+    arg_parser.add_argument('--batch', metavar='DIR_OR_GLOB',
+                            help='convert every matching JSON file, e.g. "data/dialogue/*.json"')
+    arg_parser.add_argument('--out-dir', help='batch output directory (default: next to each input)')
+    arg_parser.add_argument('--workers', type=int, help='batch worker processes (default: CPU count)')
+    arg_parser.add_argument('--force', action='store_true', help='batch: reconvert even if outputs are up to date')
+    arg_parser.add_argument('--resource-dir', help='check every referenced asset against this directory')
+    args = arg_parser.parse_args()
+
+    if args.batch:
+        json_paths = expand_batch_inputs(args.batch)
+        if not json_paths:
+            print(f"Error: No JSON files match: {args.batch}")
+            sys.exit(1)
+        summary = convert_batch(json_paths, args.out_dir, args.workers, args.force, args.resource_dir)
+        print_batch_summary(summary)
+        sys.exit(1 if summary['failed'] else 0)
+
+    if not args.json_file:
+        arg_parser.print_usage()
         sys.exit(1)
 
-    json_file = sys.argv[1]
-    output_file = sys.argv[2] if len(sys.argv) > 2 else None
+    json_file = args.json_file
+    output_file = args.output_file
 
     if not os.path.exists(json_file):
         print(f"Error: File not found: {json_file}")
         sys.exit(1)
 
-    result = convert_json_to_renpy(json_file, output_file)
+    if args.incremental and not output_file:
+        print("Error: --incremental requires an output_file")
+        sys.exit(1)
 
-    if output_file:
+    if args.incremental:
+        stats = incremental_json_to_renpy(json_file, output_file, args.cache, args.resource_dir)
+        if stats['mode'] == 'unchanged':
+            print(f"RenPy script is up to date: {output_file}")
+        elif stats['mode'] == 'patched':
+            print(f"RenPy script updated: {output_file} ({stats['nodes']} nodes regenerated)")
+        else:
+            print(f"RenPy script saved to: {output_file}")
+    elif output_file:
+        stream_json_to_renpy(json_file, output_file, args.resource_dir)
         print(f"RenPy script saved to: {output_file}")
     else:
-        print(result)
+        generator = RenPyGenerator(load_dialogue_json(json_file), args.resource_dir)
+        warn_missing_assets(generator)
+        for line in generator.iter_lines():
+            print(line)
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+from langchain_core.messages import convert_to_messages, message_to_dict, messages_from_dict, messages_to_dict
+from langchain_core.prompt_values import PromptValue
+
+# 缓存模式：
+#   off        不使用缓存
+#   readwrite  命中即返回，未命中请求上游并写入
+#   record     总是请求上游并覆盖写入(录制)
+#   replay     只读缓存，未命中直接报错(离线回放)
+CACHE_MODES = ('off', 'readwrite', 'record', 'replay')
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'llm_cache')
+DEFAULT_MAX_BYTES = 512 << 20
+# 超过上限后淘汰到上限的这个比例，避免每次写入都触发扫描
+EVICT_TARGET_RATIO = 0.9
+CACHE_KEY_VERSION = '1'
+
+
+class CacheMissError(RuntimeError):
+    pass
+
+
+def normalize_llm_input(llm_input) -> list:
+    if isinstance(llm_input, PromptValue):
+        return llm_input.to_messages()
+    if isinstance(llm_input, str):
+        return convert_to_messages([llm_input])
+    return convert_to_messages(llm_input)
+
+
+def make_cache_key(identity: dict, llm_input, parser=None) -> str:
+    """由模型身份(提供方/地址/模型/温度)、渲染后的提示词和解析器的 schema 计算内容地址"""
+    schema = None
+    if parser is not None and getattr(parser, 'pydantic_object', None) is not None:
+        schema = parser.pydantic_object.model_json_schema()
+    payload = {
+        'v': CACHE_KEY_VERSION,
+        'llm': identity,
+        'messages': messages_to_dict(normalize_llm_input(llm_input)),
+        'schema': schema,
+    }
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """磁盘上的 LLM 响应缓存，按内容寻址，按总大小做 LRU 淘汰(以 mtime 作为最近使用时间)。
+
+    同一进程内第 n 次发出的相同请求对应第 n 条记录，因此"重新生成"这类重复请求在回放时
+    依旧能拿到各自的结果；而同时在途的相同请求会合并为一次上游调用。
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, mode='readwrite', max_bytes=DEFAULT_MAX_BYTES):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"未知的缓存模式: {mode}，可选: {', '.join(CACHE_MODES)}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._occurrences = {}
+        self._inflight = {}
+        self._ainflight = {}
+        self._size = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    # -------------------------- 存储 --------------------------
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(f.read())
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return messages_from_dict([entry['message']])[0]
+
+    def put(self, key: str, message) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'message': message_to_dict(message)}, ensure_ascii=False).encode('utf-8')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        # 覆盖已有条目时(如 record 模式)只计入大小的变化，避免估算值虚高而过早淘汰
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TARGET_RATIO
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    def clear(self) -> None:
+        for _, _, path in list(self._entries()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+            self._occurrences.clear()
+
+    # -------------------------- 查询 --------------------------
+    def _occurrence_key(self, key: str) -> str:
+        # 调用方需持有 self._lock
+        n = self._occurrences.get(key, 0)
+        self._occurrences[key] = n + 1
+        return key if n == 0 else f'{key}-{n}'
+
+    def _lookup(self, entry_key: str):
+        if self.mode == 'record':
+            return None
+        message = self.get(entry_key)
+        if message is not None:
+            self.hits += 1
+            return message
+        if self.mode == 'replay':
+            raise CacheMissError(f"回放模式下缓存未命中: {entry_key}")
+        self.misses += 1
+        return None
+
+    def lookup(self, key: str):
+        """不合并请求的查询(用于流式输出)：返回 (条目键, 缓存的消息或 None)，未命中时由调用方 put(条目键, 消息)"""
+        with self._lock:
+            entry_key = self._occurrence_key(key)
+        return entry_key, self._lookup(entry_key)
+
+    def get_or_call(self, key: str, call):
+        """同步版本：命中返回缓存，否则调用 call() 并写入；同时在途的相同请求只调用一次上游"""
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                entry_key = self._occurrence_key(key)
+                pending = self._inflight[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.result()
+
+        try:
+            message = self._lookup(entry_key)
+            if message is None:
+                message = call()
+                self.put(entry_key, message)
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        else:
+            pending.set_result(message)
+            return message
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def aget_or_call(self, key: str, acall):
+        """异步版本，语义同 get_or_call"""
+        loop = asyncio.get_running_loop()
+        inflight_key = (id(loop), key)
+        with self._lock:
+            pending = self._ainflight.get(inflight_key)
+            if pending is None:
+                entry_key = self._occurrence_key(key)
+                pending = self._ainflight[inflight_key] = loop.create_future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return await asyncio.shield(pending)
+
+        try:
+            message = await asyncio.to_thread(self._lookup, entry_key)
+            if message is None:
+                message = await acall()
+                await asyncio.to_thread(self.put, entry_key, message)
+        except BaseException as e:
+            pending.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            pending.exception()
+            raise
+        else:
+            pending.set_result(message)
+            return message
+        finally:
+            with self._lock:
+                self._ainflight.pop(inflight_key, None)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    """按环境变量创建进程内共享的缓存：
+    LLM_CACHE_MODE(off/readwrite/record/replay，默认 off)、LLM_CACHE_DIR、LLM_CACHE_MAX_MB"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            mode = os.environ.get('LLM_CACHE_MODE', 'off')
+            if mode == 'off':
+                return None
+            max_mb = os.environ.get('LLM_CACHE_MAX_MB')
+            _default_cache = ResponseCache(
+                cache_dir=os.environ.get('LLM_CACHE_DIR', DEFAULT_CACHE_DIR),
+                mode=mode,
+                max_bytes=int(max_mb) << 20 if max_mb else DEFAULT_MAX_BYTES,
+            )
+        return _default_cache
@@ -1,39 +1,191 @@
+import asyncio
+import contextlib
+import os
+import threading
+import time
+import typing
+import warnings
+import weakref
+from functools import lru_cache
 from langchain_core.prompts import PromptTemplate
 from langchain.chat_models import init_chat_model
-from langchain_core.output_parsers import PydanticOutputParser
-from pydantic import BaseModel, Field
+from langchain_core.runnables import RunnableLambda
+from langchain_core.messages import message_chunk_to_message
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from typing import Literal
+import llm_cache
+import rate_limit
+import telemetry
+from output_repair import RepairingPydanticOutputParser, compact_format_instructions, response_format
+from chat_history import ChatHistory, estimate_tokens
+
+# 每个 LlmChat 实例同时在途的异步请求数上限
+DEFAULT_MAX_CONCURRENCY = 8
+# 预估 tpm 用量时假定的输出长度，调用结束后按实际用量修正
+EXPECTED_OUTPUT_TOKENS = 1024
+# 提示词模板中静态内容至少要有这个比例位于变量之前(服务端按前缀命中缓存)
+PREFIX_MIN_RATIO = 0.9
+
+
+# 进程内共享的模型客户端池，键为 (provider, base_url, model, api_key)
+_client_pool = {}
+_client_pool_lock = threading.Lock()
+
+
+def get_chat_model(model_name, model_provider, base_url, api_key):
+    """同一 provider/base_url/model 只创建一次客户端，复用其 HTTP 连接池；温度等参数在调用处 bind"""
+    key = (model_provider, base_url, model_name, api_key)
+    with _client_pool_lock:
+        client = _client_pool.get(key)
+        if client is None:
+            client = init_chat_model(
+                model=model_name,
+                model_provider=model_provider,
+                base_url=base_url,
+                api_key=api_key,
+                # 重试交给 rate_limit，由它统一退避并感知 429
+                max_retries=0,
+            )
+            _client_pool[key] = client
+    return client
+
+
+class EvaluationResult(BaseModel):
+    res: Literal["Perfect", "Good", "OK", "Just so so", "Bad"] = Field(description="最终的评判结果"
+                                                                                   "Perfect 是非常好，无需改动了"
+                                                                                   "Good 是很好第二档，可以进行一定修改"
+                                                                                   "OK 是还行第三档，有缺点"
+                                                                                   "Just so so 是一般第四档"
+                                                                                   "Bad 是很差第五档")
+    reason_and_advise: str = Field(description="得出评价的理由及可能的改进方向")
+
+
+EVALUATION_PARSER = RepairingPydanticOutputParser(pydantic_object=EvaluationResult)
+
+
+@lru_cache(maxsize=None)
+def get_evaluation_prompt(result_type, json_mode=False):
+    """评价提示词只与 result_type 有关，每种只渲染一次；原生 JSON 模式下使用简短的格式说明"""
+    format_instructions = compact_format_instructions(EvaluationResult) if json_mode \
+        else EVALUATION_PARSER.get_format_instructions()
+    # 静态部分(角色、要求、格式)在前，result_type 与待评价文本在后，便于命中服务端的前缀缓存
+    return PromptTemplate(
+        template="""你是一个专业的作品评价家。请根据所给的内容(大纲，文章，剧本等)完成评价.
+                        评价的要求务必严格，给出的改进建议务必详细,确保下次评估是达到更好的水准.
+
+            请严格按照以下格式输出,不要添加任何额外说明：：
+            {format_instructions}
+
+            """ + f'完成{result_type}的评价.' + """
+            要鉴赏的文本：{text}
+
+            输出：""",
+        input_variables=["text"],
+        partial_variables={"format_instructions": format_instructions}
+    )
+
+def static_prompt_prefix(prompt_template, variable="text"):
+    """模板在 variable 之前的静态部分(用两个不同的值渲染后取公共前缀)"""
+    first = prompt_template.format(**{variable: '\x00'})
+    second = prompt_template.format(**{variable: '\x01'})
+    return os.path.commonprefix([first, second])
+
+
+def check_prompt_prefix(prompt_template, variable="text", min_ratio=PREFIX_MIN_RATIO):
+    """检查模板的静态内容是否基本都在变量之前；返回 (静态前缀长度, 静态内容总长度)，不满足时抛出 ValueError"""
+    prefix = static_prompt_prefix(prompt_template, variable)
+    static_chars = len(prompt_template.format(**{variable: ''}))
+    if static_chars and len(prefix) < static_chars * min_ratio:
+        raise ValueError(f"提示词模板的静态前缀只占 {len(prefix)}/{static_chars} 字符，"
+                         f"请把角色、规则、格式说明放到 {{{variable}}} 之前")
+    return len(prefix), static_chars
+
+
+# 流式结构化输出时，只有片段中出现这些字符才可能有新的列表项完成，才重新做一次部分解析
+ITEM_BOUNDARY_CHARS = frozenset('}],')
+
+
+def list_item_adapters(pydantic_object):
+    """模型中所有 List[...] 字段 -> 列表项的校验器"""
+    adapters = {}
+    for name, field in pydantic_object.model_fields.items():
+        if typing.get_origin(field.annotation) is list:
+            adapters[name] = TypeAdapter(typing.get_args(field.annotation)[0])
+    return adapters
+
+
+def parse_partial_object(text):
+    # 跳过 ```json 之类的前缀，从第一个 { 开始按不完整 JSON 解析
+    start = text.find('{')
+    if start < 0:
+        return None
+    try:
+        return parse_partial_json(text[start:])
+    except ValueError:
+        return None
+
+
+def message_usage(message):
+    """usage_metadata；DeepSeek 在 prompt_cache_hit_tokens 中返回前缀缓存命中数时补进 input_token_details"""
+    usage = getattr(message, 'usage_metadata', None)
+    if not usage:
+        return usage
+    token_usage = (getattr(message, 'response_metadata', None) or {}).get('token_usage') or {}
+    hit = token_usage.get('prompt_cache_hit_tokens')
+    if hit is not None and not (usage.get('input_token_details') or {}).get('cache_read'):
+        usage = {**usage, 'input_token_details': {**(usage.get('input_token_details') or {}), 'cache_read': hit}}
+    return usage
 
 
 class LlmChat:
     def __init__(self, model_name, temperature, model_provider, base_url, api_key,
-                 pydantic_object=None, prompt_template=None):
+                 pydantic_object=None, prompt_template=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 cache=None, history_max_tokens=None, summarize_history=False, system_prompt=None,
+                 rate_limiter=None, json_mode=False):
         self.model_name = model_name
         self.model_provider = model_provider
         self.base_url = base_url
         self.api_key = api_key
         self.temperature = temperature
-        self.llm = init_chat_model(
-            model=self.model_name,
-            temperature=self.temperature,
-            model_provider=self.model_provider,
-            base_url=self.base_url,
-            api_key=self.api_key,
-        )
-        self.messages = []
+        self.llm = self._bind_llm()
+        # continuous_chat 的对话历史：超出 history_max_tokens 时淘汰(或总结)最旧的对话
+        self.history = ChatHistory(max_tokens=history_max_tokens)
+        self.summarize_history = summarize_history
+        if system_prompt:
+            self.history.pin({"role": "system", "content": system_prompt})
         self.new_message = None
+        # 最近一次上游调用的用量(usage_metadata)，其中 input_token_details.cache_read 为命中前缀缓存的 token 数
+        self.last_usage = None
+        # 本实例累计实际消耗的 token 数(命中响应缓存的调用不计)，用于生成-评价循环的 token 预算
+        self.total_tokens = 0
+        self._usage_lock = threading.Lock()
+        # 最近一次流式调用的统计：首 token 时间、总耗时、输出 token 数、生成速度
+        self.last_stream_stats = None
+        self.max_concurrency = max_concurrency
+        # 信号量与事件循环绑定，按循环分别创建
+        self._semaphores = weakref.WeakKeyDictionary()
+        # 响应缓存，未指定时按环境变量 LLM_CACHE_MODE 等决定(默认关闭)
+        self.cache = cache if cache is not None else llm_cache.default_cache()
+        # 同一服务的所有调用共用一个限流器(令牌桶 + 自适应并发 + 退避重试)
+        self.rate_limiter = rate_limiter or rate_limit.limiter_for(base_url)
+        # 按 result_type 缓存的评价链
+        self._evaluate_chains = {}
+        # 结构化输出使用服务商原生的 JSON 模式：True/'json_object' 或 'json_schema'，
+        # 此时提示词中的 format_instructions 换成简短的 JSON Schema
+        self.json_mode = json_mode
 
-        # 如果提供了 Pydantic 对象，就创建解析器
-        self.parser = PydanticOutputParser(pydantic_object=pydantic_object) if pydantic_object else None
+        # 如果提供了 Pydantic 对象，就创建解析器(解析失败时先在本地修复)
+        self.parser = RepairingPydanticOutputParser(pydantic_object=pydantic_object) if pydantic_object else None
 
         # 设置默认提示模板
         if prompt_template is None:
             if pydantic_object:
-                format_instructions = self.parser.get_format_instructions() if self.parser else ""
+                format_instructions = self._format_instructions()
                 self.prompt_template = PromptTemplate(
-                    template="""请处理以下文本：
+                    template="""格式要求：{format_instructions}
+                    请按上述格式处理以下文本：
                     输入文本：{text}
-                    格式要求：{format_instructions}
                     输出：""",
                     input_variables=["text"],
                     partial_variables={"format_instructions": format_instructions}
@@ -45,86 +197,411 @@ class LlmChat:
                     input_variables=["text"]
                 )
         else:
-            self.prompt_template = prompt_template
+            self.prompt_template = self._prepare_prompt(prompt_template)
 
         # 创建链
+        self._build_chain()
+
+    def _format_instructions(self):
+        if self.json_mode:
+            return compact_format_instructions(self.parser.pydantic_object)
+        return self.parser.get_format_instructions()
+
+    def _prepare_prompt(self, prompt_template):
+        # JSON 模式下替换模板里预置的长 format_instructions
+        if self.json_mode and self.parser and 'format_instructions' in prompt_template.partial_variables:
+            return prompt_template.partial(format_instructions=self._format_instructions())
+        return prompt_template
+
+    def _llm_for(self, parser=None):
+        if parser is not None and self.json_mode:
+            return self.llm.bind(response_format=response_format(parser.pydantic_object, self.json_mode))
+        return self.llm
+
+    def _bind_llm(self):
+        return get_chat_model(self.model_name, self.model_provider, self.base_url, self.api_key).bind(
+            temperature=self.temperature)
+
+    def _model_step(self, parser=None):
+        # 链中的模型调用一步；调用时才读取 self.llm / self.cache，换温度或缓存后链无需重建
+        def call(llm_input):
+            return self._invoke_llm(llm_input, parser)
+
+        async def acall(llm_input):
+            return await self._ainvoke_llm(llm_input, parser)
+
+        return RunnableLambda(call, afunc=acall)
+
+    @staticmethod
+    def _check_prefix(input_text, prefix):
+        # 自由文本的生成提示词会原样发给模型：检查它是否以调用方给出的共享前缀开头
+        event = telemetry.current_span()
+        if event is not None:
+            event['prefix_chars'] = len(prefix)
+        if not input_text.startswith(prefix):
+            if event is not None:
+                event['prefix_mismatch'] = True
+            warnings.warn("提示词没有以共享前缀开头，无法命中前缀缓存")
+
+    def _build_chain(self):
+        # 模板的静态内容应基本位于 {text} 之前，便于命中服务端的前缀缓存
+        if "text" in self.prompt_template.input_variables:
+            try:
+                check_prompt_prefix(self.prompt_template)
+            except ValueError as e:
+                warnings.warn(str(e), stacklevel=3)
         if self.parser:
-            self.chain = self.prompt_template | self.llm | self.parser
+            self.chain = self.prompt_template | self._model_step(self.parser) | self.parser
         else:
-            self.chain = self.prompt_template | self.llm
+            self.chain = self.prompt_template | self._model_step()
+
+    # -------------------------- 缓存 --------------------------
+    def _cache_identity(self):
+        return {
+            'provider': self.model_provider,
+            'base_url': self.base_url,
+            'model': self.model_name,
+            'temperature': self.temperature,
+            **({'json_mode': self.json_mode} if self.json_mode else {}),
+        }
+
+    def _use_cache(self):
+        return self.cache is not None and self.cache.enabled
+
+    # -------------------------- 上游调用(限流 + 重试) --------------------------
+    @staticmethod
+    def _estimate_request_tokens(llm_input):
+        text = ''.join(str(message.content) for message in llm_cache.normalize_llm_input(llm_input))
+        return estimate_tokens(text) + EXPECTED_OUTPUT_TOKENS
+
+    @staticmethod
+    def _used_tokens(message):
+        usage = getattr(message, 'usage_metadata', None)
+        return usage['total_tokens'] if usage else None
+
+    def _call_upstream(self, llm_input, parser=None):
+        message = self.rate_limiter.call(self._llm_for(parser).invoke, llm_input,
+                                         estimated_tokens=self._estimate_request_tokens(llm_input),
+                                         usage=self._used_tokens, on_retry=telemetry.note_retry)
+        self._record_usage(message)
+        return message
+
+    async def _acall_upstream(self, llm_input, parser=None):
+        message = await self.rate_limiter.acall(self._llm_for(parser).ainvoke, llm_input,
+                                                estimated_tokens=self._estimate_request_tokens(llm_input),
+                                                usage=self._used_tokens, on_retry=telemetry.note_retry)
+        self._record_usage(message)
+        return message
+
+    def _record_usage(self, message, event=None):
+        usage = message_usage(message)
+        self.last_usage = usage
+        if usage:
+            with self._usage_lock:
+                self.total_tokens += usage.get('total_tokens', 0)
+        telemetry.add_usage(usage, event)
+
+    def _open_stream(self, llm_input, parser=None, event=None):
+        # 连接建立与第一个片段到达之前的错误可以重试，之后的错误直接抛出
+        def open_stream():
+            iterator = iter(self._llm_for(parser).stream(llm_input, **self._stream_kwargs()))
+            return next(iterator, None), iterator
+
+        def on_retry(exc, attempt, delay):
+            telemetry.note_retry(exc, attempt, delay, event=event)
+
+        # 返回的生成器读完或关闭时才释放并发槽，并按最终用量修正 tpm 令牌桶
+        return self.rate_limiter.stream(open_stream, estimated_tokens=self._estimate_request_tokens(llm_input),
+                                        usage=self._used_tokens, on_retry=on_retry)
+
+    def _invoke_llm(self, llm_input, parser=None, coalesce=True):
+        if not self._use_cache():
+            return self._call_upstream(llm_input, parser)
+        key = llm_cache.make_cache_key(self._cache_identity(), llm_input, parser)
+        if coalesce:
+            return self.cache.get_or_call(key, lambda: self._call_upstream(llm_input, parser))
+        # 有意重复的请求(多个候选)不合并：各自占一个出现序号，分别命中或写入缓存
+        entry_key, message = self.cache.lookup(key)
+        if message is None:
+            message = self._call_upstream(llm_input, parser)
+            self.cache.put(entry_key, message)
+        return message
+
+    async def _ainvoke_llm(self, llm_input, parser=None):
+        if not self._use_cache():
+            return await self._acall_upstream(llm_input, parser)
+        key = llm_cache.make_cache_key(self._cache_identity(), llm_input, parser)
+        return await self.cache.aget_or_call(key, lambda: self._acall_upstream(llm_input, parser))
+
+    # -------------------------- 调用记录 --------------------------
+    def _span(self, mode, bind=True, **fields):
+        return telemetry.span('llm', mode, bind=bind, model=self.model_name, provider=self.model_provider,
+                              temperature=self.temperature, **fields)
 
     def singe_chat(self, input_text):
-        result = self.llm.invoke(input_text)
+        with self._span('singe_chat'):
+            result = self._invoke_llm(input_text)
         self.new_message = result
         return result
 
+    def sample_chats(self, input_text, n, max_concurrency=None, prefix=None):
+        """对同一输入并行独立生成 n 个候选，返回消息列表；不修改 new_message。
+        给出 prefix 时检查 input_text 以它开头，不满足时告警并在调用记录中标记 prefix_mismatch"""
+        step = RunnableLambda(lambda text: self._invoke_llm(text, coalesce=False))
+        with self._span('sample_chats', candidates=n):
+            if prefix:
+                self._check_prefix(input_text, prefix)
+            return step.batch([input_text] * n, config={"max_concurrency": max_concurrency or self.max_concurrency})
+
     def continuous_chat(self, input_text):
         # 添加用户消息
-        self.messages.append({"role": "user", "content": input_text})
+        self.history.append("user", input_text)
+        self._trim_history()
 
-        response = self.llm.invoke(self.messages)
+        with self._span('continuous_chat'):
+            response = self._invoke_llm(self.history.to_messages())
 
-        self.messages.append({"role": "assistant", "content": response.content})
+        self.history.append("assistant", response.content)
+        self._trim_history()
         self.new_message = response.content
         return response.content
 
     def structured_chat(self, input_text):
         """专门用于结构化输出的聊天"""
-        result = self.chain.invoke({"text": input_text})
+        with self._span('structured_chat'):
+            result = self.chain.invoke({"text": input_text})
         self.new_message = result
         return result
 
+    # -------------------------- 流式接口 --------------------------
+    def _stream_kwargs(self):
+        # openai 兼容接口需显式请求才会在流末尾返回用量
+        return {'stream_usage': True} if self.model_provider == 'openai' else {}
+
+    def _stream_message(self, llm_input, parser=None, event=None):
+        """逐片段产出文本，生成器的返回值是完整消息；统计写入 self.last_stream_stats 与 event"""
+        start = time.perf_counter()
+        stats = {'ttft': None, 'duration': None, 'output_tokens': 0, 'tokens_per_sec': None, 'cached': False}
+        self.last_stream_stats = stats
+
+        entry_key = None
+        if self._use_cache():
+            key = llm_cache.make_cache_key(self._cache_identity(), llm_input, parser)
+            entry_key, message = self.cache.lookup(key)
+            if message is not None:
+                stats['cached'] = True
+                stats['ttft'] = time.perf_counter() - start
+                yield str(message.text)
+                stats['duration'] = time.perf_counter() - start
+                return message
+
+        message = None
+        chunk_count = 0
+        # 调用方提前停止读取时立即关闭上游的流，归还并发槽
+        with contextlib.closing(self._open_stream(llm_input, parser, event)) as chunks:
+            for chunk in chunks:
+                message = chunk if message is None else message + chunk
+                text = str(chunk.text)
+                if text:
+                    if stats['ttft'] is None:
+                        stats['ttft'] = time.perf_counter() - start
+                    chunk_count += 1
+                    yield text
+        if message is None:
+            raise ValueError("模型没有返回任何内容")
+        message = message_chunk_to_message(message)
+
+        stats['duration'] = time.perf_counter() - start
+        usage = message.usage_metadata
+        stats['output_tokens'] = usage['output_tokens'] if usage else chunk_count
+        generating = stats['duration'] - (stats['ttft'] or 0)
+        if generating > 0:
+            stats['tokens_per_sec'] = stats['output_tokens'] / generating
+        if event is not None:
+            event['ttft'] = stats['ttft']
+            event['tokens_per_sec'] = stats['tokens_per_sec']
+        self._record_usage(message, event)
+        if entry_key is not None:
+            self.cache.put(entry_key, message)
+        return message
+
+    def stream_chat(self, input_text):
+        """与 singe_chat 相同，但逐 token 产出文本；结束后 new_message 为完整消息"""
+        # 生成器内不绑定当前 span，避免在 yield 之间影响调用方
+        with self._span('stream_chat', bind=False) as event:
+            self.new_message = yield from self._stream_message(input_text, event=event)
+        return self.new_message
+
+    def stream_structured_chat(self, input_text, field=None, on_token=None):
+        """与 structured_chat 相同，但边接收边解析：每当 field(默认第一个列表字段)中的一项完整时就产出该项。
+        on_token 可用于实时显示原始输出；结束后 new_message 为完整的解析结果"""
+        if not self.parser:
+            raise ValueError("stream_structured_chat 需要在创建 LlmChat 时提供 pydantic_object")
+        adapters = list_item_adapters(self.parser.pydantic_object)
+        if field is None:
+            if not adapters:
+                raise ValueError(f"{self.parser.pydantic_object.__name__} 没有列表字段，无法增量产出")
+            field = next(iter(adapters))
+        adapter = adapters[field]
+
+        with self._span('stream_structured_chat', bind=False) as event:
+            result = yield from self._stream_items(input_text, field, adapter, on_token, event)
+            event['items'] = len(getattr(result, field))
+        self.new_message = result
+        return result
+
+    def _stream_items(self, input_text, field, adapter, on_token, event):
+        stream = self._stream_message(self.prompt_template.invoke({"text": input_text}), self.parser, event)
+        pieces = []
+        emitted = 0
+        while True:
+            try:
+                piece = next(stream)
+            except StopIteration as stop:
+                message = stop.value
+                break
+            if on_token:
+                on_token(piece)
+            pieces.append(piece)
+            if ITEM_BOUNDARY_CHARS.isdisjoint(piece):
+                continue
+            partial = parse_partial_object(''.join(pieces))
+            items = partial.get(field) if isinstance(partial, dict) else None
+            if not isinstance(items, list):
+                continue
+            # 最后一项可能还没写完，之前的都已完整
+            while emitted < len(items) - 1:
+                try:
+                    item = adapter.validate_python(items[emitted])
+                except ValidationError:
+                    break
+                emitted += 1
+                yield item
+
+        result = self.parser.invoke(message)
+        for item in getattr(result, field)[emitted:]:
+            yield item
+        return result
+
+    @property
+    def messages(self):
+        return self.history.to_messages()
+
     def clear_messages(self):
-        self.messages = []
+        self.history.clear()
+
+    @staticmethod
+    def _summary_prompt(summary, evicted):
+        dialogue = '\n'.join(f"{message['role']}: {message['content']}" for message in evicted)
+        return f"之前的摘要：{summary or '无'}\n新增的对话：\n{dialogue}\n" \
+               "请把之前的摘要与新增的对话合并为一段简洁的摘要，保留人物、设定、用户要求等关键信息，只输出摘要。"
+
+    def _trim_history(self):
+        # 对话历史超出预算时淘汰最旧的对话；开启 summarize_history 时把被淘汰的内容合并进摘要
+        evicted = self.history.evict()
+        if evicted and self.summarize_history:
+            with self._span('summarize_history', messages=len(evicted)):
+                response = self._invoke_llm(self._summary_prompt(self.history.summary, evicted))
+            self.history.set_summary(response.content)
 
     def change_prompt_template(self, prompt_template):
-        self.prompt_template = prompt_template
-        if self.parser:
-            self.chain = self.prompt_template | self.llm | self.parser
-        else:
-            self.chain = self.prompt_template | self.llm
+        self.prompt_template = self._prepare_prompt(prompt_template)
+        self._build_chain()
 
     def change_parser(self, pydantic_object):
-        self.parser = PydanticOutputParser(pydantic_object=pydantic_object)
-        self.chain = self.prompt_template | self.llm | self.parser
+        self.parser = RepairingPydanticOutputParser(pydantic_object=pydantic_object)
+        self._build_chain()
 
     def change_temperature(self, temperature):
+        # 复用池中的客户端，只重新绑定温度
         self.temperature = temperature
-        self.llm = init_chat_model(
-            model=self.model_name,
-            temperature=self.temperature,
-            model_provider=self.model_provider,
-            base_url=self.base_url,
-            api_key=self.api_key,
-        )
+        self.llm = self._bind_llm()
+        self._build_chain()
+
+    def get_evaluate_chain(self, result_type):
+        chain = self._evaluate_chains.get(result_type)
+        if chain is None:
+            prompt = get_evaluation_prompt(result_type, bool(self.json_mode))
+            chain = prompt | self._model_step(EVALUATION_PARSER) | EVALUATION_PARSER
+            self._evaluate_chains[result_type] = chain
+        return chain
 
     def evaluate_result(self, result, result_type):
-        class EvaluationResult(BaseModel):
-            res: Literal["Perfect", "Good", "OK", "Just so so", "Bad"] = Field(description="最终的评判结果"
-                                                                                           "Perfect 是非常好，无需改动了"
-                                                                                           "Good 是很好第二档，可以进行一定修改"
-                                                                                           "OK 是还行第三档，有缺点"
-                                                                                           "Just so so 是一般第四档"
-                                                                                           "Bad 是很差第五档")
-            reason_and_advise: str = Field(description="得出评价的理由及可能的改进方向")
-
-        parser = PydanticOutputParser(pydantic_object=EvaluationResult)
-        prompt = PromptTemplate(
-            template=f'完成{result_type}的评价.' + """你是一个专业的作品评价家。请根据所给的内容(大纲，文章，剧本等)完成评价.
-                        评价的要求务必严格，给出的改进建议务必详细,确保下次评估是达到更好的水准.
+        with self._span('evaluate_result', result_type=result_type) as event:
+            final_result = self.get_evaluate_chain(result_type).invoke({"text": result})
+            event['res'] = final_result.res
+        print(final_result.res)
+        return final_result
 
-            要鉴赏的文本：{text}
+    def evaluate_results(self, results, result_type, max_concurrency=None):
+        """批量评价多个候选(多段落/多候选)，一次扇出，最多 max_concurrency 个请求同时在途"""
+        with self._span('evaluate_results', result_type=result_type, items=len(results)):
+            final_results = self.get_evaluate_chain(result_type).batch(
+                [{"text": result} for result in results],
+                config={"max_concurrency": max_concurrency or self.max_concurrency},
+            )
+        for final_result in final_results:
+            print(final_result.res)
+        return final_results
 
-            请严格按照以下格式输出,不要添加任何额外说明：：
-            {format_instructions}
+    # -------------------------- 异步接口 --------------------------
+    # 与同步方法一一对应，基于 ainvoke；同一实例上并发调用时 new_message 只保留最后完成的结果，
+    # 需要每次结果时请使用返回值
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
 
-            输出：""",
-            input_variables=["text"],
-            partial_variables={"format_instructions": parser.get_format_instructions()}
-        )
+    def set_max_concurrency(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def asingle_chat(self, input_text):
+        async with self._get_semaphore():
+            with self._span('asingle_chat'):
+                result = await self._ainvoke_llm(input_text)
+        self.new_message = result
+        return result
+
+    async def _atrim_history(self):
+        # 与 _trim_history 相同，但摘要请求走 _ainvoke_llm，不阻塞事件循环
+        evicted = self.history.evict()
+        if evicted and self.summarize_history:
+            async with self._get_semaphore():
+                with self._span('summarize_history', messages=len(evicted)):
+                    response = await self._ainvoke_llm(self._summary_prompt(self.history.summary, evicted))
+            self.history.set_summary(response.content)
 
-        chain = prompt | self.llm | parser
+    async def acontinuous_chat(self, input_text):
+        self.history.append("user", input_text)
+        await self._atrim_history()
 
-        final_result = chain.invoke({"text": result})
+        async with self._get_semaphore():
+            with self._span('acontinuous_chat'):
+                response = await self._ainvoke_llm(self.history.to_messages())
+
+        self.history.append("assistant", response.content)
+        await self._atrim_history()
+        self.new_message = response.content
+        return response.content
+
+    async def astructured_chat(self, input_text):
+        async with self._get_semaphore():
+            with self._span('astructured_chat'):
+                result = await self.chain.ainvoke({"text": input_text})
+        self.new_message = result
+        return result
+
+    async def aevaluate_result(self, result, result_type):
+        async with self._get_semaphore():
+            with self._span('aevaluate_result', result_type=result_type) as event:
+                final_result = await self.get_evaluate_chain(result_type).ainvoke({"text": result})
+                event['res'] = final_result.res
         print(final_result.res)
         return final_result
+
+    async def aevaluate_results(self, results, result_type):
+        return list(await asyncio.gather(*(self.aevaluate_result(result, result_type) for result in results)))
@@ -0,0 +1,164 @@
+import json
+import re
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.utils.json import parse_partial_json
+from pydantic import ValidationError
+
+import telemetry
+
+THINK_RE = re.compile(r'<think>.*?</think>', re.S)
+FENCE_RE = re.compile(r'```(?:json|JSON)?\s*\n?(.*?)```', re.S)
+PY_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+
+# -------------------------- JSON 提取与修复 --------------------------
+def extract_json_text(text: str) -> str:
+    """去掉 <think> 段、代码块标记与前后的说明文字，取出第一个完整的 {...} / [...]；没有闭合时取到末尾"""
+    text = THINK_RE.sub('', text)
+    fenced = FENCE_RE.search(text)
+    if fenced and any(c in fenced.group(1) for c in '{['):
+        text = fenced.group(1)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        return text.strip()
+    start = min(starts)
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '{[':
+            depth += 1
+        elif ch in '}]':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+
+def repair_json_text(text: str) -> str:
+    """在字符串外：去掉 } ] 前多余的逗号，把 True/False/None 换成 JSON 字面量"""
+    out = []
+    in_string = False
+    escaped = False
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch == ',':
+            j = i + 1
+            while j < len(text) and text[j] in ' \t\r\n':
+                j += 1
+            if j >= len(text) or text[j] not in '}]':
+                out.append(ch)
+        elif ch.isalpha():
+            j = i
+            while j < len(text) and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            word = text[i:j]
+            out.append(PY_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    return ''.join(out)
+
+
+def loads_tolerant(text: str):
+    """依次尝试：原样解析 -> 提取并修复后解析 -> 补全被截断的结构后解析；都失败时抛出 ValueError"""
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        pass
+    repaired = repair_json_text(extract_json_text(text))
+    try:
+        return json.loads(repaired, strict=False)
+    except ValueError:
+        pass
+    result = parse_partial_json(repaired, strict=False)
+    if result is None:
+        raise ValueError("无法从模型输出中解析出 JSON")
+    return result
+
+
+# -------------------------- 解析器 --------------------------
+class RepairingPydanticOutputParser(PydanticOutputParser):
+    """标准解析失败时先在本地修复(代码块、多余文字、尾逗号、截断等)再校验，修复失败才抛出原异常"""
+
+    def parse_result(self, result, *, partial=False):
+        try:
+            return super().parse_result(result, partial=partial)
+        except OutputParserException as e:
+            if partial:
+                raise
+            try:
+                parsed = self.pydantic_object.model_validate(loads_tolerant(result[0].text))
+            except (ValueError, ValidationError):
+                raise e
+            event = telemetry.current_span()
+            if event is not None:
+                event['repaired'] = event.get('repaired', 0) + 1
+            return parsed
+
+
+# -------------------------- 原生 JSON 模式 --------------------------
+# 值为 {字段名: 子 schema} 的关键字：其中名为 title 的是字段，不是 title 元数据
+SCHEMA_MAP_KEYWORDS = frozenset({'properties', 'patternProperties', '$defs', 'definitions', 'dependentSchemas'})
+# 值是数据而不是 schema 的关键字，原样保留
+SCHEMA_DATA_KEYWORDS = frozenset({'default', 'const', 'enum', 'examples'})
+
+
+def _strip_titles(schema):
+    if isinstance(schema, list):
+        return [_strip_titles(value) for value in schema]
+    if not isinstance(schema, dict):
+        return schema
+    stripped = {}
+    for key, value in schema.items():
+        if key == 'title':
+            continue
+        if key in SCHEMA_MAP_KEYWORDS and isinstance(value, dict):
+            stripped[key] = {name: _strip_titles(sub_schema) for name, sub_schema in value.items()}
+        elif key in SCHEMA_DATA_KEYWORDS:
+            stripped[key] = value
+        else:
+            stripped[key] = _strip_titles(value)
+    return stripped
+
+
+def compact_format_instructions(pydantic_object) -> str:
+    """原生 JSON 模式下替代 format_instructions 的简短说明(只保留去掉 title 的 JSON Schema)"""
+    schema = json.dumps(_strip_titles(pydantic_object.model_json_schema()), ensure_ascii=False, separators=(',', ':'))
+    return f"只输出一个符合以下 JSON Schema 的 JSON 对象：{schema}"
+
+
+def response_format(pydantic_object, json_mode):
+    """json_mode: True/'json_object' 使用 JSON 对象模式；'json_schema' 使用带 schema 的结构化输出"""
+    if json_mode == 'json_schema':
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": pydantic_object.__name__, "schema": pydantic_object.model_json_schema()},
+        }
+    return {"type": "json_object"}
@@ -0,0 +1,293 @@
+import os
+import sys
+import time
+from graphlib import TopologicalSorter
+
+import const
+import tools
+import telemetry
+import json_to_renpy
+import get_outline
+import get_complete_script
+import get_dialogue
+import get_structured_json
+import refine
+from schemas import ArticleOutline, ArticleCompleteScript, Dialogue
+
+# 每次运行一个目录，各阶段的产物即断点：产物存在且不早于其输入就视为已完成
+PIPELINE_DIR = os.environ.get('PIPELINE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'pipeline'))
+REQUIREMENT_FILE = 'requirement.txt'
+
+
+def write_text_atomic(text: str, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class Stage:
+    def __init__(self, name: str, deps: tuple, inputs, outputs, run):
+        """
+        :param deps: 依赖的阶段名，决定执行顺序
+        :param inputs: inputs(pipeline) -> 输入文件列表，用于判断产物是否过期
+        :param outputs: outputs(pipeline) -> 产物文件列表(只在依赖完成后调用)
+        :param run: run(pipeline, force)，force 为 True 时忽略已有的子单元断点
+        """
+        self.name = name
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run = run
+
+
+class Pipeline:
+    def __init__(self, run_dir: str, stages: list[Stage], strict_model: bool = False,
+                 workers: int = get_dialogue.DEFAULT_WORKERS, refine_options: dict = None):
+        self.run_dir = run_dir
+        self.stages = {stage.name: stage for stage in stages}
+        self.strict_model = strict_model
+        self.workers = workers
+        # 各阶段生成-评价循环的参数(候选数、最大轮数、token 预算)，见 refine.refine
+        self.refine_options = refine_options or {}
+        self.order = list(TopologicalSorter({stage.name: stage.deps for stage in stages}).static_order())
+
+    def path(self, *parts: str) -> str:
+        return os.path.join(self.run_dir, *parts)
+
+    def load(self, name: str, schema):
+        return tools.read_json_file(self.path(name), schema=schema)
+
+    def save(self, name: str, model) -> None:
+        tools.save_dict_to_json(model.model_dump() if hasattr(model, 'model_dump') else model, self.path(name))
+
+    @property
+    def requirement(self) -> str:
+        with open(self.path(REQUIREMENT_FILE), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def set_requirement(self, requirement: str) -> None:
+        # 内容不变时不重写，避免刷新修改时间让已有产物全部过期
+        if os.path.exists(self.path(REQUIREMENT_FILE)) and self.requirement == requirement:
+            return
+        write_text_atomic(requirement, self.path(REQUIREMENT_FILE))
+
+    def is_done(self, name: str) -> bool:
+        stage = self.stages[name]
+        if not all(self.is_done(dep) for dep in stage.deps):
+            return False
+        inputs = stage.inputs(self)
+        return all(tools.is_fresh(path, inputs) for path in stage.outputs(self))
+
+    def downstream(self, names) -> set[str]:
+        result = set(names)
+        for name in self.order:
+            if any(dep in result for dep in self.stages[name].deps):
+                result.add(name)
+        return result
+
+    def upstream(self, name: str) -> set[str]:
+        result = {name}
+        for dep in self.stages[name].deps:
+            result |= self.upstream(dep)
+        return result
+
+    def run(self, until: str = None, force=()) -> None:
+        """按依赖顺序执行到 until(默认全部)；force 中的阶段及其下游即使已完成也重新执行"""
+        targets = self.upstream(until) if until else set(self.order)
+        forced = self.downstream(force)
+        for name in self.order:
+            if name not in targets:
+                continue
+            if name not in forced and self.is_done(name):
+                print(f"[{name}] up to date")
+                continue
+            print(f"[{name}] running")
+            start = time.perf_counter()
+            with telemetry.span('stage', name, run=os.path.basename(self.run_dir)):
+                self.stages[name].run(self, name in forced)
+            print(f"[{name}] done in {time.perf_counter() - start:.1f}s")
+
+    def status(self) -> list[tuple[str, str]]:
+        result = []
+        for name in self.order:
+            stage = self.stages[name]
+            if not all(self.is_done(dep) for dep in stage.deps):
+                result.append((name, 'waiting'))
+            else:
+                result.append((name, 'done' if self.is_done(name) else 'pending'))
+        return result
+
+
+# -------------------------- 各阶段 --------------------------
+def dialogue_paths(p: Pipeline) -> list[str]:
+    script = p.load('complete_script.json', ArticleCompleteScript)
+    return [p.path('dialogue', f'{i}.json') for i in range(len(script.content))]
+
+
+def run_outline(p: Pipeline, force: bool) -> None:
+    p.save('outline.json', get_outline.generate_outline(p.requirement, strict_model=p.strict_model,
+                                                             **p.refine_options))
+
+
+def run_complete_script(p: Pipeline, force: bool) -> None:
+    outline = p.load('outline.json', ArticleOutline)
+    script = get_complete_script.generate_complete_script(outline, strict_model=p.strict_model, **p.refine_options)
+    p.save('complete_script.json', script)
+
+
+def write_renpy(json_path: str, output_path: str) -> None:
+    json_to_renpy.stream_json_to_renpy(json_path, output_path + '.tmp')
+    os.replace(output_path + '.tmp', output_path)
+
+
+def save_dialogue(p: Pipeline, i: int, dialogue: Dialogue) -> None:
+    """保存一段台本(断点)，并立即转出这一章单独可玩的预览 chapters/<i>.rpy，不必等全部段落完成"""
+    p.save(os.path.join('dialogue', f'{i}.json'), dialogue)
+    p.save(os.path.join('chapters', f'{i}.json'), get_structured_json.build_dialogue_graph([dialogue]))
+    write_renpy(p.path('chapters', f'{i}.json'), p.path('chapters', f'{i}.rpy'))
+
+
+def run_dialogue(p: Pipeline, force: bool) -> None:
+    # 每段单独落盘：中途失败后重跑只补缺失或过期的段落
+    script = p.load('complete_script.json', ArticleCompleteScript)
+    inputs = [p.path('complete_script.json')]
+    pending = [i for i in range(len(script.content))
+               if force or not tools.is_fresh(p.path('dialogue', f'{i}.json'), inputs)]
+    get_dialogue.generate_dialogues(script.content, lambda i, dialogue: save_dialogue(p, i, dialogue),
+                                    workers=p.workers, strict_model=p.strict_model, indices=pending,
+                                    **p.refine_options)
+
+
+def run_script_and_dialogue_streamed(p: Pipeline) -> None:
+    """
+    complete_script 与 dialogue 重叠执行：剧本的结构化输出每解析出一段，就交给台本的工作线程，
+    前面章节的台本与 .rpy 预览在后面的段落还在输出时就已完成
+    """
+    outline = p.load('outline.json', ArticleOutline)
+    done = set()
+    start = time.perf_counter()
+
+    def paragraphs():
+        stream = get_complete_script.stream_complete_script(outline, strict_model=p.strict_model, **p.refine_options)
+        i = 0
+        while True:
+            try:
+                content = next(stream)
+            except StopIteration as stop:
+                script = stop.value
+                break
+            if i == 0:
+                event['first_paragraph'] = time.perf_counter() - start
+            yield i, content
+            i += 1
+        p.save('complete_script.json', script)
+        # 剧本最后才能落盘，已经完成的段落要改为不早于剧本，续跑时才不会被当作过期
+        for i in list(done):
+            os.utime(p.path('dialogue', f'{i}.json'))
+
+    def save(i, dialogue):
+        save_dialogue(p, i, dialogue)
+        done.add(i)
+        if 'first_chapter' not in event:
+            event['first_chapter'] = time.perf_counter() - start
+            print(f"[dialogue] first playable chapter after {event['first_chapter']:.1f}s: "
+                  f"{p.path('chapters', f'{i}.rpy')}")
+
+    with telemetry.span('stage', 'complete_script+dialogue', run=os.path.basename(p.run_dir)) as event:
+        get_dialogue.generate_dialogue_stream(paragraphs(), save, workers=p.workers, strict_model=p.strict_model,
+                                              **p.refine_options)
+
+
+def run_graph(p: Pipeline, force: bool) -> None:
+    script = p.load('complete_script.json', ArticleCompleteScript)
+    dialogues = [tools.read_json_file(path, schema=Dialogue) for path in dialogue_paths(p)]
+    p.save('story.json', get_structured_json.build_dialogue_graph(dialogues, script.article_script_name))
+
+
+def run_renpy(p: Pipeline, force: bool) -> None:
+    write_renpy(p.path('story.json'), p.path('story.rpy'))
+
+
+STAGES = [
+    Stage('outline', (), lambda p: [p.path(REQUIREMENT_FILE)], lambda p: [p.path('outline.json')], run_outline),
+    Stage('complete_script', ('outline',), lambda p: [p.path('outline.json')],
+          lambda p: [p.path('complete_script.json')], run_complete_script),
+    Stage('dialogue', ('complete_script',), lambda p: [p.path('complete_script.json')], dialogue_paths, run_dialogue),
+    Stage('graph', ('dialogue',), dialogue_paths, lambda p: [p.path('story.json')], run_graph),
+    Stage('renpy', ('graph',), lambda p: [p.path('story.json')], lambda p: [p.path('story.rpy')], run_renpy),
+]
+
+
+def run_pipelined(p: Pipeline, until: str = None, force=()) -> None:
+    """同 Pipeline.run，但剧本需要(重新)生成时，complete_script 与 dialogue 流式重叠执行"""
+    targets = p.upstream(until) if until else set(p.order)
+    forced = p.downstream(force)
+    if 'dialogue' in targets and ('complete_script' in forced or not p.is_done('complete_script')):
+        p.run('outline', [name for name in force if name == 'outline'])
+        print("[complete_script+dialogue] running")
+        start = time.perf_counter()
+        run_script_and_dialogue_streamed(p)
+        print(f"[complete_script+dialogue] done in {time.perf_counter() - start:.1f}s")
+        # 之后的阶段按修改时间判断即会过期重跑，无需再强制
+        force = ()
+    p.run(until, force)
+
+
+def create_pipeline(run_name: str, strict_model: bool = False, workers: int = get_dialogue.DEFAULT_WORKERS,
+                    refine_options: dict = None) -> Pipeline:
+    return Pipeline(os.path.join(PIPELINE_DIR, run_name), STAGES, strict_model, workers, refine_options)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    stage_names = [stage.name for stage in STAGES]
+    arg_parser = argparse.ArgumentParser(description="Run the whole story pipeline, from requirements to a Ren'Py script. "
+                                                     "Finished stages and paragraphs are skipped on re-run.")
+    arg_parser.add_argument('requirement', nargs='?', help='story requirements (omit to resume an existing run)')
+    arg_parser.add_argument('--requirement-file', help='read the requirements from this file')
+    arg_parser.add_argument('--run', help='run name under data/pipeline (default: current time)')
+    arg_parser.add_argument('--until', choices=stage_names, help='stop after this stage')
+    arg_parser.add_argument('--force', action='append', default=[], choices=stage_names,
+                            help='re-run this stage and everything after it (repeatable)')
+    arg_parser.add_argument('--strict', action='store_true', help='only accept results rated Perfect')
+    arg_parser.add_argument('--workers', type=int, default=get_dialogue.DEFAULT_WORKERS,
+                            help=f'paragraphs generated concurrently (default: {get_dialogue.DEFAULT_WORKERS})')
+    arg_parser.add_argument('--candidates', type=int, default=refine.DEFAULT_CANDIDATES,
+                            help=f'drafts generated and evaluated in parallel per round '
+                                 f'(default: {refine.DEFAULT_CANDIDATES})')
+    arg_parser.add_argument('--max-rounds', type=int, default=refine.DEFAULT_MAX_ROUNDS,
+                            help=f'give up revising after this many rounds and keep the best draft '
+                                 f'(default: {refine.DEFAULT_MAX_ROUNDS})')
+    arg_parser.add_argument('--token-budget', type=int,
+                            help='stop revising a draft once its loop has used this many tokens')
+    arg_parser.add_argument('--pipelined', action='store_true',
+                            help='start dialogue generation for each paragraph as soon as the script streams it')
+    arg_parser.add_argument('--status', action='store_true', help='print the state of each stage and exit')
+    args = arg_parser.parse_args()
+
+    refine_options = {'candidates': args.candidates, 'max_rounds': args.max_rounds, 'token_budget': args.token_budget}
+    pipeline = create_pipeline(args.run or const.time_now_, args.strict, args.workers, refine_options)
+    requirement = args.requirement
+    if args.requirement_file:
+        with open(args.requirement_file, 'r', encoding='utf-8') as f:
+            requirement = f.read()
+
+    if args.status:
+        for name, state in pipeline.status():
+            print(f"{name:<16} {state}")
+        sys.exit(0)
+
+    if requirement:
+        pipeline.set_requirement(requirement)
+    elif not os.path.exists(pipeline.path(REQUIREMENT_FILE)):
+        print(f"Error: No requirements given and no existing run at {pipeline.run_dir}")
+        sys.exit(1)
+
+    if args.pipelined:
+        run_pipelined(pipeline, args.until, args.force)
+    else:
+        pipeline.run(args.until, args.force)
+    print(f"Pipeline output: {pipeline.run_dir}")
@@ -0,0 +1,358 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows：令牌桶只在进程内共享
+    fcntl = None
+
+# 各服务的限额，按账号实际等级调整。rpm/tpm 为 None 表示不限，只做自适应并发与退避
+LIMITS = {
+    'api.deepseek.com': {'rpm': None, 'tpm': None, 'max_concurrency': 16},
+    'api.siliconflow.cn': {'rpm': None, 'tpm': None, 'max_concurrency': 8},
+    'api-inference.modelscope.cn': {'rpm': None, 'tpm': None, 'max_concurrency': 4},
+}
+DEFAULT_LIMITS = {'rpm': None, 'tpm': None, 'max_concurrency': 8}
+# 多进程共享令牌桶状态的目录，可用环境变量 RATE_LIMIT_STATE_DIR 覆盖
+STATE_DIR = os.environ.get('RATE_LIMIT_STATE_DIR', os.path.join(tempfile.gettempdir(), 'ren_ai_rate_limit'))
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# AIMD：成功时每个"窗口"并发上限 +1，被限流时减半，延迟超标时乘以 LATENCY_DECREASE
+LATENCY_DECREASE = 0.9
+
+TRANSIENT_ERROR_NAMES = frozenset({
+    'Timeout', 'TimeoutException', 'ConnectTimeout', 'ReadTimeout', 'APITimeoutError',
+    'ConnectionError', 'APIConnectionError', 'ConnectError', 'RemoteProtocolError', 'ChunkedEncodingError',
+})
+
+
+# -------------------------- 错误分类与退避 --------------------------
+def error_status(exc):
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def classify_error(exc):
+    """'throttled'(429)、'transient'(5xx/超时/连接错误，可重试) 或 None(不重试)"""
+    status = error_status(exc)
+    if status == 429:
+        return 'throttled'
+    if status is not None:
+        return 'transient' if status >= 500 or status in (408, 409) else None
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return 'transient'
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(exc).__mro__):
+        return 'transient'
+    return None
+
+
+def retry_after(exc):
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, hint=None):
+    # 指数退避 + full jitter；服务端给了 Retry-After 时至少等待这么久
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+    return max(delay, hint) if hint else delay
+
+
+# -------------------------- 令牌桶 --------------------------
+class TokenBucket:
+    """每分钟 rate_per_min 个令牌的令牌桶；state_path 不为空且支持 fcntl 时状态存于文件，多进程共享。
+    rate_per_min 为 None 时不限速，只用于共享 block() 设定的暂停时间。"""
+
+    def __init__(self, rate_per_min=None, capacity=None, state_path=None):
+        self.rate = rate_per_min / 60.0 if rate_per_min else None
+        # 默认最多攒 10 秒的令牌，避免突发
+        self.capacity = capacity or (max(1.0, rate_per_min / 6) if rate_per_min else 0.0)
+        self.state_path = state_path if fcntl is not None else None
+        self._lock = threading.Lock()
+        self._memory_state = {'tokens': self.capacity, 'stamp': time.time(), 'blocked_until': 0.0}
+
+    @contextlib.contextmanager
+    def _state(self):
+        with self._lock:
+            if self.state_path is None:
+                yield self._memory_state
+                return
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = {'tokens': self.capacity, 'stamp': time.time(), 'blocked_until': 0.0}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_acquire(self, amount=1.0):
+        """取 amount 个令牌；成功返回 0，否则返回建议等待的秒数(不扣令牌)"""
+        with self._state() as state:
+            now = time.time()
+            blocked = state.get('blocked_until', 0.0) - now
+            if blocked > 0:
+                return blocked
+            if self.rate is None:
+                return 0.0
+            tokens = min(self.capacity, state['tokens'] + (now - state['stamp']) * self.rate)
+            state['stamp'] = now
+            # 单次需求超过桶容量时，桶满即放行(允许欠账)，否则永远等不到
+            need = min(amount, self.capacity)
+            if tokens >= need:
+                state['tokens'] = tokens - amount
+                return 0.0
+            state['tokens'] = tokens
+            return (need - tokens) / self.rate
+
+    def acquire(self, amount=1.0):
+        while True:
+            wait = self.try_acquire(amount)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, amount=1.0):
+        # 状态文件的 flock 与读写放到线程里，不阻塞事件循环
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, amount)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def consume(self, amount):
+        """事后修正：实际用量超过预估时补扣(可为负数表示退还)"""
+        if self.rate is None or not amount:
+            return
+        with self._state() as state:
+            state['tokens'] = min(self.capacity, state['tokens'] - amount)
+
+    def block(self, seconds):
+        """被限流后让所有使用者(包括其他进程)暂停 seconds 秒"""
+        with self._state() as state:
+            state['blocked_until'] = max(state.get('blocked_until', 0.0), time.time() + seconds)
+
+
+# -------------------------- 限流器 --------------------------
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class RateLimiter:
+    """rpm/tpm 令牌桶 + AIMD 自适应并发 + 指数退避重试，同一服务的所有调用共用一个实例"""
+
+    def __init__(self, name, rpm=None, tpm=None, max_concurrency=8, min_concurrency=1,
+                 latency_target=None, max_retries=MAX_RETRIES, state_dir=STATE_DIR):
+        self.name = name
+        safe_name = re.sub(r'[^\w.-]', '_', name)
+        self.request_bucket = TokenBucket(rpm, state_path=os.path.join(state_dir, f'{safe_name}.rpm.json'))
+        self.token_bucket = TokenBucket(tpm, state_path=os.path.join(state_dir, f'{safe_name}.tpm.json')) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        # 从较低的并发起步，按成功逐步加到上限
+        self.limit = float(min(max_concurrency, max(min_concurrency, 4)))
+        self.in_flight = 0
+        self.retries = 0
+        self.throttled = 0
+        self._cond = threading.Condition()
+        # 等待并发槽的协程：(事件循环, future)，由 _leave 唤醒
+        self._async_waiters = []
+
+    # 并发槽
+    def _try_enter(self):
+        with self._cond:
+            if self.in_flight < max(1, int(self.limit)):
+                self.in_flight += 1
+                return True
+            return False
+
+    def _enter(self):
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def _aenter(self):
+        # 没有空闲的槽时登记一个 future 等 _leave 唤醒，唤醒后重新抢槽；不轮询，也不占用线程
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < max(1, int(self.limit)):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def _leave(self, latency, throttled=False, failed=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            elif self.latency_target and latency > self.latency_target:
+                self.limit = max(self.min_concurrency, self.limit * LATENCY_DECREASE)
+            elif not failed:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # 等待者所在的事件循环已关闭
+                pass
+
+    def _acquire_buckets(self, estimated_tokens):
+        self.request_bucket.acquire(1)
+        if self.token_bucket is not None and estimated_tokens:
+            self.token_bucket.acquire(estimated_tokens)
+
+    async def _aacquire_buckets(self, estimated_tokens):
+        await self.request_bucket.aacquire(1)
+        if self.token_bucket is not None and estimated_tokens:
+            await self.token_bucket.aacquire(estimated_tokens)
+
+    def _settle_tokens(self, estimated_tokens, used_tokens):
+        if self.token_bucket is not None and used_tokens is not None:
+            self.token_bucket.consume(used_tokens - (estimated_tokens or 0))
+
+    def _on_error(self, exc, attempt, on_retry=None):
+        """返回重试前的等待秒数；不该重试时返回 None"""
+        kind = classify_error(exc)
+        if kind is None or attempt >= self.max_retries:
+            return None
+        self.retries += 1
+        delay = backoff_delay(attempt, retry_after(exc))
+        if kind == 'throttled':
+            self.throttled += 1
+            self.request_bucket.block(delay)
+        if on_retry is not None:
+            on_retry(exc, attempt, delay)
+        return delay
+
+    def call(self, func, *args, estimated_tokens=0, usage=None, on_retry=None, **kwargs):
+        """限流后调用 func(*args, **kwargs)，429/5xx/超时时退避重试。
+        usage(result) 可返回实际 token 用量，用于修正 tpm 令牌桶；每次重试前调用 on_retry(异常, 第几次, 等待秒数)"""
+        attempt = 0
+        while True:
+            self._acquire_buckets(estimated_tokens)
+            self._enter()
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._leave(time.monotonic() - start, throttled=classify_error(e) == 'throttled', failed=True)
+                delay = self._on_error(e, attempt, on_retry)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._leave(time.monotonic() - start)
+            self._settle_tokens(estimated_tokens, usage(result) if usage else None)
+            return result
+
+    async def acall(self, afunc, *args, estimated_tokens=0, usage=None, on_retry=None, **kwargs):
+        """call 的异步版本，afunc 返回协程；令牌桶的文件读写在线程中进行"""
+        attempt = 0
+        while True:
+            await self._aacquire_buckets(estimated_tokens)
+            await self._aenter()
+            start = time.monotonic()
+            try:
+                result = await afunc(*args, **kwargs)
+            except Exception as e:
+                self._leave(time.monotonic() - start, throttled=classify_error(e) == 'throttled', failed=True)
+                delay = await asyncio.to_thread(self._on_error, e, attempt, on_retry)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._leave(time.monotonic() - start)
+            await asyncio.to_thread(self._settle_tokens, estimated_tokens, usage(result) if usage else None)
+            return result
+
+    def stream(self, open_stream, *args, estimated_tokens=0, usage=None, on_retry=None, **kwargs):
+        """call 的流式版本：open_stream(*args, **kwargs) 返回 (第一个片段, 其余片段的迭代器)，逐个产出片段。
+        第一个片段到达前出错时退避重试；并发槽一直占用到流读完或被关闭为止，
+        结束时按各片段 usage(片段) 之和修正 tpm 令牌桶"""
+        attempt = 0
+        while True:
+            self._acquire_buckets(estimated_tokens)
+            self._enter()
+            start = time.monotonic()
+            try:
+                first, iterator = open_stream(*args, **kwargs)
+            except Exception as e:
+                self._leave(time.monotonic() - start, throttled=classify_error(e) == 'throttled', failed=True)
+                delay = self._on_error(e, attempt, on_retry)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            break
+
+        # AIMD 按首个片段的延迟调整，与非流式调用的语义一致
+        latency = time.monotonic() - start
+        used = None
+        throttled = failed = False
+        try:
+            for chunk in (iterator if first is None else itertools.chain([first], iterator)):
+                chunk_tokens = usage(chunk) if usage else None
+                if chunk_tokens is not None:
+                    used = (used or 0) + chunk_tokens
+                yield chunk
+        except Exception as e:
+            throttled, failed = classify_error(e) == 'throttled', True
+            raise
+        finally:
+            self._leave(latency, throttled=throttled, failed=failed)
+            self._settle_tokens(estimated_tokens, used)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name, **overrides):
+    """按服务名(通常是域名)取进程内共享的限流器，参数取自 LIMITS"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = RateLimiter(name, **{**LIMITS.get(name, DEFAULT_LIMITS), **overrides})
+            _limiters[name] = limiter
+        return limiter
+
+
+def limiter_for(url, **overrides):
+    return get_limiter(urlparse(url).netloc or url, **overrides)
@@ -0,0 +1,72 @@
+import warnings
+
+import telemetry
+
+# 评价等级，从好到差
+RATINGS = ("Perfect", "Good", "OK", "Just so so", "Bad")
+# 默认每轮只生成一个候选(与原来逐个生成、评价、修改的流程一致)
+DEFAULT_CANDIDATES = 1
+# 最多进行的轮数，避免模型状态不好时无限循环；None 为不限
+DEFAULT_MAX_ROUNDS = 5
+
+
+def message_text(message) -> str:
+    return message.content if hasattr(message, 'content') else str(message)
+
+
+def is_accepted(evaluation, strict_model: bool = False) -> bool:
+    return evaluation.res == "Perfect" or (evaluation.res == "Good" and not strict_model)
+
+
+def rank(evaluation) -> int:
+    return RATINGS.index(evaluation.res)
+
+
+def refine(llm, first_prompt: str, revise, result_type: str, strict_model: bool = False,
+           candidates: int = DEFAULT_CANDIDATES, max_rounds: int = DEFAULT_MAX_ROUNDS, token_budget: int = None,
+           prefix: str = None, name: str = 'refine', **span_fields) -> str:
+    """
+    生成-评价-修改循环：每轮并行生成 candidates 个候选并并行评价，保留目前评价最好的一个；
+    未通过时按它的修改建议生成下一轮候选
+    :param first_prompt: 第一轮的生成提示词
+    :param revise: revise(稿件文本, 修改建议) -> 下一轮的修改提示词
+    :param max_rounds: 最多进行的轮数，None 为不限
+    :param token_budget: 本次循环最多消耗的 token 数(按 llm.total_tokens 统计)，用完后不再开始新一轮；None 为不限
+    :param prefix: 第一轮与修改轮提示词共同的开头(原始要求)，每轮发送前检查，便于命中前缀缓存
+    :param name: 记录到 telemetry 的循环名，span_fields 为附加字段
+    :return: 通过评价的稿件文本；轮数或预算用完仍未通过时返回评价最好的一个，同时写入 llm.new_message
+    """
+    best_text = None
+    best_evaluation = None
+    prompt = first_prompt
+    start_tokens = llm.total_tokens
+    with telemetry.span('loop', name, iterations=0, candidates=candidates, **span_fields) as loop_event:
+        while True:
+            texts = [message_text(message) for message in llm.sample_chats(prompt, candidates, prefix=prefix)]
+            if candidates == 1:
+                evaluations = [llm.evaluate_result(texts[0], result_type)]
+            else:
+                evaluations = llm.evaluate_results(texts, result_type)
+            loop_event['iterations'] += 1
+            for text, evaluation in zip(texts, evaluations):
+                if best_evaluation is None or rank(evaluation) < rank(best_evaluation):
+                    best_text, best_evaluation = text, evaluation
+            loop_event['tokens'] = llm.total_tokens - start_tokens
+            loop_event['res'] = best_evaluation.res
+
+            if is_accepted(best_evaluation, strict_model):
+                break
+            if max_rounds is not None and loop_event['iterations'] >= max_rounds:
+                loop_event['stopped'] = 'max_rounds'
+                break
+            if token_budget is not None and loop_event['tokens'] >= token_budget:
+                loop_event['stopped'] = 'token_budget'
+                break
+            prompt = revise(best_text, best_evaluation.reason_and_advise)
+
+    if 'stopped' in loop_event:
+        warnings.warn(f"{result_type}在{loop_event['iterations']}轮后仍未通过评价({loop_event['stopped']})，"
+                      f"使用评价最好的结果：{best_evaluation.res}")
+    print(best_text)
+    llm.new_message = best_text
+    return best_text
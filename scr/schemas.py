@@ -0,0 +1,28 @@
+from pydantic import BaseModel, Field
+from typing import List
+
+
+# -------------------------- 大纲 / 完整剧本 / 对话台本 --------------------------
+class ArticleOutline(BaseModel):
+    article_outline_name: str = Field(description="文章大纲的名字")
+    content: str = Field(description="文章大纲的内容")
+
+
+class ArticleCompleteScript(BaseModel):
+    article_script_name: str = Field(description="剧本的名字")
+    paragraph_num: int = Field(description="剧本的分段的数目")
+    content: List[str] = Field(description="剧本的完整内容，按段落分")
+    site: str = Field(description="该分段的地点名")
+
+
+# 首先定义对话项的子模型
+class DialogueItem(BaseModel):
+    name: str = Field(description="说话者的名字。若是旁白则写‘旁白’")
+    dialogue_content: str = Field(description="该说话者说的内容，合理分句，单句应不超过15字")
+
+
+# 然后定义主模型，包含对话项列表
+class Dialogue(BaseModel):
+    dialogues: List[DialogueItem] = Field(description="具体的对话列表")
+    chapter_name: str = Field(description="这个章节的名称")
+    site: str = Field(description="这个章节故事的地点的详细描述")
@@ -0,0 +1,235 @@
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# 每次运行一个 JSON Lines 日志，退出时另写汇总(.summary.txt)与 Prometheus 文本(.prom)
+LOG_DIR = os.environ.get('TELEMETRY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'telemetry'))
+# 多个进程设置相同的 TELEMETRY_RUN_ID 即写入同一个日志
+RUN_ID = os.environ.get('TELEMETRY_RUN_ID') or f"{time.strftime('%Y-%m-%d %H_%M_%S')}_{os.getpid()}"
+ENABLED = os.environ.get('TELEMETRY', 'on') != 'off'
+
+# 价格：元 / 百万 token，(输入未命中缓存, 输入命中缓存, 输出)，按官网价格调整
+PRICES = {
+    'deepseek-chat': (2.0, 0.2, 3.0),
+    'deepseek-reasoner': (2.0, 0.2, 3.0),
+}
+TOKEN_FIELDS = ('prompt_tokens', 'completion_tokens', 'reasoning_tokens', 'cache_hit_tokens')
+
+_current = contextvars.ContextVar('telemetry_span', default=None)
+_lock = threading.Lock()
+_events = []
+_log_file = None
+
+
+def log_path():
+    return os.path.join(LOG_DIR, f'{RUN_ID}.jsonl')
+
+
+def record(event):
+    if not ENABLED:
+        return
+    global _log_file
+    line = json.dumps(event, ensure_ascii=False, default=str) + '\n'
+    with _lock:
+        _events.append(event)
+        if _log_file is None:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            _log_file = open(log_path(), 'a', encoding='utf-8')
+        _log_file.write(line)
+        _log_file.flush()
+
+
+def new_event(kind, name, **fields):
+    return {'run': RUN_ID, 'kind': kind, 'name': name, 'time': time.time(), 'retries': 0, **fields}
+
+
+@contextlib.contextmanager
+def span(kind, name, bind=True, **fields):
+    """记录一次调用：墙钟时间、是否出错，以及期间 add_usage/note_retry 累加到它上的用量与重试次数。
+    bind=False 时不设为当前 span(用于生成器，避免在 yield 之间串到调用方的上下文)，需显式传给 add_usage"""
+    event = new_event(kind, name, **fields)
+    token = _current.set(event) if bind else None
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException as e:
+        event['error'] = type(e).__name__
+        raise
+    finally:
+        event['wall_time'] = time.perf_counter() - start
+        if token is not None:
+            _current.reset(token)
+        record(event)
+
+
+def traced(kind, name=None, **fields):
+    """装饰器：每次调用记录为一个 span"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, name or func.__name__, **fields):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def current_span():
+    return _current.get()
+
+
+def add_usage(usage, event=None):
+    """把 LangChain 的 usage_metadata 累加到当前 span"""
+    event = event if event is not None else _current.get()
+    if event is None or not usage:
+        return
+    input_details = usage.get('input_token_details') or {}
+    output_details = usage.get('output_token_details') or {}
+    with _lock:
+        event['requests'] = event.get('requests', 0) + 1
+        for field, value in (('prompt_tokens', usage.get('input_tokens')),
+                             ('completion_tokens', usage.get('output_tokens')),
+                             ('reasoning_tokens', output_details.get('reasoning')),
+                             ('cache_hit_tokens', input_details.get('cache_read'))):
+            if value:
+                event[field] = event.get(field, 0) + value
+
+
+def add_openai_usage(usage, event=None):
+    """openai SDK 的 response.usage"""
+    if usage is None:
+        return
+    prompt_details = getattr(usage, 'prompt_tokens_details', None)
+    completion_details = getattr(usage, 'completion_tokens_details', None)
+    add_usage({
+        'input_tokens': usage.prompt_tokens,
+        'output_tokens': usage.completion_tokens,
+        'input_token_details': {'cache_read': getattr(prompt_details, 'cached_tokens', None)},
+        'output_token_details': {'reasoning': getattr(completion_details, 'reasoning_tokens', None)},
+    }, event)
+
+
+def note_retry(exc=None, attempt=None, delay=None, event=None):
+    event = event if event is not None else _current.get()
+    if event is None:
+        return
+    with _lock:
+        event['retries'] += 1
+        event['last_retry_error'] = type(exc).__name__ if exc is not None else None
+
+
+def event_cost(event):
+    price = PRICES.get(event.get('model'))
+    if price is None:
+        return None
+    hit = event.get('cache_hit_tokens', 0)
+    miss = event.get('prompt_tokens', 0) - hit
+    return (miss * price[0] + hit * price[1] + event.get('completion_tokens', 0) * price[2]) / 1e6
+
+
+# -------------------------- 汇总报告 --------------------------
+def aggregate(events):
+    groups = defaultdict(lambda: defaultdict(float))
+    for event in events:
+        if 'wall_time' not in event:
+            continue
+        stats = groups[(event['kind'], event['name'], event.get('model') or '')]
+        stats['calls'] += 1
+        stats['errors'] += 1 if event.get('error') else 0
+        stats['wall_time'] += event['wall_time']
+        stats['retries'] += event.get('retries', 0)
+        stats['iterations'] += event.get('iterations', 0)
+        if event.get('ttft') is not None:
+            stats['ttft'] += event['ttft']
+            stats['ttft_count'] += 1
+        for field in TOKEN_FIELDS:
+            stats[field] += event.get(field, 0)
+        cost = event_cost(event)
+        if cost is not None:
+            stats['cost'] += cost
+    return groups
+
+
+def summary(events=None):
+    groups = aggregate(_events if events is None else events)
+    header = f"{'kind':<8} {'name':<24} {'model':<20} {'calls':>6} {'err':>4} {'retry':>5} {'iter':>5} " \
+             f"{'wall(s)':>9} {'ttft(s)':>8} {'prompt':>9} {'compl':>9} {'reason':>8} {'cached':>8} {'cost':>8}"
+    lines = [header, '-' * len(header)]
+    total = defaultdict(float)
+    for (kind, name, model), stats in sorted(groups.items()):
+        ttft = stats['ttft'] / stats['ttft_count'] if stats['ttft_count'] else 0
+        lines.append(f"{kind:<8} {name:<24} {model:<20} {stats['calls']:>6.0f} {stats['errors']:>4.0f} "
+                     f"{stats['retries']:>5.0f} {stats['iterations']:>5.0f} {stats['wall_time']:>9.1f} {ttft:>8.2f} "
+                     f"{stats['prompt_tokens']:>9.0f} {stats['completion_tokens']:>9.0f} "
+                     f"{stats['reasoning_tokens']:>8.0f} {stats['cache_hit_tokens']:>8.0f} {stats['cost']:>8.3f}")
+        for field in ('calls', 'wall_time', 'cost') + TOKEN_FIELDS:
+            total[field] += stats[field]
+    lines.append('-' * len(header))
+    lines.append(f"total: {total['calls']:.0f} calls, {total['wall_time']:.1f}s, "
+                 f"{total['prompt_tokens']:.0f} prompt / {total['completion_tokens']:.0f} completion tokens "
+                 f"({total['cache_hit_tokens']:.0f} cache hits), cost {total['cost']:.3f}")
+    return '\n'.join(lines)
+
+
+def prometheus_text(events=None):
+    groups = aggregate(_events if events is None else events)
+    metrics = (
+        ('renai_calls_total', 'counter', 'calls', 'Calls per kind/name/model'),
+        ('renai_errors_total', 'counter', 'errors', 'Calls that raised'),
+        ('renai_retries_total', 'counter', 'retries', 'Retries after 429/5xx/timeouts'),
+        ('renai_iterations_total', 'counter', 'iterations', 'Generate-evaluate iterations'),
+        ('renai_wall_seconds_total', 'counter', 'wall_time', 'Wall time spent in calls'),
+        ('renai_ttft_seconds_total', 'counter', 'ttft', 'Sum of time to first token'),
+        ('renai_cost_total', 'counter', 'cost', 'Estimated cost'),
+    )
+    lines = []
+    for metric, metric_type, field, help_text in metrics:
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}']
+        for (kind, name, model), stats in sorted(groups.items()):
+            lines.append(f'{metric}{{kind="{kind}",name="{name}",model="{model}"}} {stats[field]:g}')
+    lines += ['# HELP renai_tokens_total Tokens by type', '# TYPE renai_tokens_total counter']
+    for (kind, name, model), stats in sorted(groups.items()):
+        for field in TOKEN_FIELDS:
+            token_type = field[:-len('_tokens')]
+            lines.append(f'renai_tokens_total{{kind="{kind}",name="{name}",model="{model}",type="{token_type}"}} '
+                         f'{stats[field]:g}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(events=None, base_path=None):
+    events = _events if events is None else events
+    if not events:
+        return None
+    base_path = base_path or os.path.join(LOG_DIR, RUN_ID)
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+    with open(base_path + '.summary.txt', 'w', encoding='utf-8') as f:
+        f.write(summary(events) + '\n')
+    with open(base_path + '.prom', 'w', encoding='utf-8') as f:
+        f.write(prometheus_text(events))
+    return base_path
+
+
+def load_events(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@atexit.register
+def _close():
+    if _log_file is not None:
+        write_report()
+        _log_file.close()
+
+
+if __name__ == "__main__":
+    # python telemetry.py <run.jsonl>：汇总已有日志(可包含多个进程写入的事件)
+    if len(sys.argv) != 2:
+        print("Usage: python telemetry.py <telemetry.jsonl>")
+        sys.exit(1)
+    print(summary(load_events(sys.argv[1])))
@@ -1,24 +1,69 @@
 import json
-from typing import Dict, List, Any  # 类型注解，让代码更规范
+from typing import Dict, List, Any, TYPE_CHECKING  # 类型注解，让代码更规范
 import os
-def read_json_file(file_path: str, encoding: str = "utf-8") -> Dict | List | Any:
+
+# 可选的高性能 JSON 解码器，未安装时回退到标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if TYPE_CHECKING:
+    from pydantic import BaseModel
+
+
+def loads_json(data: bytes | str) -> Dict | List | Any:
+    """
+    解析JSON文本；安装了orjson时使用orjson，否则使用标准库json
+    :param data: JSON文本（bytes或str）
+    :return: 解析后的Python对象
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_json(data: Any) -> bytes:
     """
-    读取JSON文件，解析为Python的字典/列表对象
+    序列化为紧凑的JSON文本；安装了orjson时使用orjson，否则使用标准库json
+    :param data: 待序列化的Python对象
+    :return: UTF-8编码的JSON文本（bytes）
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def read_json_file(file_path: str, encoding: str = "utf-8",
+                   schema: "type[BaseModel] | None" = None) -> Dict | List | Any:
+    """
+    读取JSON文件，解析为Python的字典/列表对象，或直接解析为指定的Pydantic模型
     :param file_path: JSON文件的路径（相对路径/绝对路径）
     :param encoding: 文件编码，默认utf-8，需兼容gbk/gb2312可手动指定
-    :return: 解析后的Python对象（字典/列表，取决于JSON文件的顶层结构）
+    :param schema: 可选的Pydantic模型类（见schemas.py）；指定后由pydantic-core一次完成解码与校验，返回模型对象
+    :return: 解析后的Python对象（字典/列表，取决于JSON文件的顶层结构）或schema的实例
     :raises: 捕获并抛出明确的异常信息，方便问题排查
     """
     try:
-        # with语句自动管理文件句柄，无需手动close，避免资源泄漏
-        with open(file_path, mode="r", encoding=encoding) as f:
-            # json.load 直接解析文件对象，区别于json.loads（解析字符串）
-            json_data = json.load(f)
-        return json_data
+        # 以二进制读取，交给快速解码器直接处理，省去一次文本解码
+        with open(file_path, mode="rb") as f:
+            raw = f.read()
+        if encoding.replace("-", "").lower() != "utf8":
+            raw = raw.decode(encoding)
+        if schema is not None:
+            return schema.model_validate_json(raw)
+        return loads_json(raw)
     except FileNotFoundError:
         raise FileNotFoundError(f"错误：未找到指定的JSON文件，路径为 {file_path}")
     except json.JSONDecodeError as e:
         raise ValueError(f"错误：JSON文件格式非法，解析失败，详情：{str(e)}")
+    except UnicodeDecodeError as e:
+        raise ValueError(f"错误：文件编码与{encoding}不符，详情：{str(e)}")
+    except ValueError as e:
+        # pydantic 的 ValidationError 是 ValueError 的子类
+        if schema is None:
+            raise
+        raise ValueError(f"错误：JSON内容不符合{schema.__name__}格式要求，详情：{str(e)}")
     except PermissionError:
         raise PermissionError(f"错误：无权限读取文件 {file_path}，请检查文件权限")
     except Exception as e:
@@ -48,10 +93,12 @@ def save_dict_to_json(
         if file_dir and not os.path.exists(file_dir):
             os.makedirs(file_dir, exist_ok=True)
 
-        # with语句自动管理文件句柄，覆盖式写入（JSON常规保存方式）
-        with open(file_path, mode="w", encoding=encoding) as f:
+        # 先写入临时文件再整体替换，写到一半中断时不会留下残缺的JSON（流水线据此判断断点）
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, mode="w", encoding=encoding) as f:
             # json.dump 直接将Python对象写入文件对象
             json.dump(data, f, indent=indent, ensure_ascii=ensure_ascii)
+        os.replace(tmp_path, file_path)
         print(f"数据已成功保存为JSON文件，路径：{file_path}")
     except PermissionError:
         raise PermissionError(f"错误：无权限写入文件 {file_path}，请检查文件/文件夹权限")
@@ -60,4 +107,17 @@ def save_dict_to_json(
     except OSError as e:
         raise OSError(f"错误：文件路径无效/写入失败，详情：{str(e)}（请检查路径是否包含特殊字符）")
     except Exception as e:
-        raise Exception(f"保存JSON文件时发生未知错误：{str(e)}")
\ No newline at end of file
+        raise Exception(f"保存JSON文件时发生未知错误：{str(e)}")
+
+
+def is_fresh(path: str, inputs: List[str]) -> bool:
+    """
+    判断产物是否为最新：path存在且修改时间不早于所有输入文件
+    :param path: 产物文件路径
+    :param inputs: 生成该产物所用的输入文件路径列表
+    :return: 产物存在且不早于任何输入时为True；输入缺失或更新过则为False
+    """
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    return all(os.path.exists(src) and os.path.getmtime(src) <= mtime for src in inputs)